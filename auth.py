@@ -1,32 +1,116 @@
 from datetime import datetime, timedelta
 from typing import Optional
-from jose import JWTError, jwt
+from collections import OrderedDict
+import base64
+import hmac
+import json
+import logging
+import threading
+import time
+import jwt
+from jwt import InvalidTokenError as JWTError
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from database import get_database
-import os
-from dotenv import load_dotenv
-from passlib.hash import bcrypt
+from database import get_async_database
+from config import get_settings
 from starlette.status import HTTP_403_FORBIDDEN
-load_dotenv()
 
-SECRET_KEY = os.getenv("SECRET_KEY", "medicine123")
-ALGORITHM = os.getenv("ALGORITHM", "HS256")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+logger = logging.getLogger("auth")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+settings = get_settings()
+
+SECRET_KEY = settings.SECRET_KEY
+ALGORITHM = settings.ALGORITHM
+ACCESS_TOKEN_EXPIRE_MINUTES = settings.ACCESS_TOKEN_EXPIRE_MINUTES
+_SIGNING_KEY = SECRET_KEY.encode()
+
+BCRYPT_ROUNDS = settings.BCRYPT_ROUNDS
+
+# argon2id for new hashes; existing bcrypt hashes still verify and are
+# upgraded on the next successful login (see password_needs_rehash)
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    default="argon2",
+    deprecated="auto",
+    argon2__type="ID",
+    argon2__memory_cost=65536,
+    argon2__time_cost=2,
+    argon2__parallelism=2,
+    bcrypt__rounds=BCRYPT_ROUNDS,
+)
 security = HTTPBearer()
 
-def hash_password(password: str) -> str:
-    return bcrypt.hash(password)
+# Successful password checks are remembered for a short while so repeat logins
+# skip the KDF. Keys are HMAC'd with SECRET_KEY; plaintexts are never stored.
+VERIFY_CACHE_SIZE = 1024
+VERIFY_CACHE_TTL = 300  # seconds
+_verify_cache: "OrderedDict[bytes, float]" = OrderedDict()
+# verify_password runs on threadpool workers; the KDF itself stays outside
+_verify_lock = threading.Lock()
+
+def _verify_cache_key(plain_password: str, hashed_password: str) -> bytes:
+    msg = plain_password.encode() + b"\x00" + hashed_password.encode()
+    return hmac.new(SECRET_KEY.encode(), msg, "sha256").digest()
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    key = _verify_cache_key(plain_password, hashed_password)
+    now = time.monotonic()
+    with _verify_lock:
+        expiry = _verify_cache.get(key)
+        if expiry is not None:
+            if expiry > now:
+                _verify_cache.move_to_end(key)
+                return True
+            del _verify_cache[key]
 
-def get_password_hash(password):
+    ok = pwd_context.verify(plain_password, hashed_password)
+    if ok:
+        # only cache successes so wrong guesses always pay the full KDF cost
+        with _verify_lock:
+            _verify_cache[key] = now + VERIFY_CACHE_TTL
+            _verify_cache.move_to_end(key)
+            if len(_verify_cache) > VERIFY_CACHE_SIZE:
+                _verify_cache.popitem(last=False)
+    return ok
+
+def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+def password_needs_rehash(hashed_password: str) -> bool:
+    return pwd_context.needs_update(hashed_password)
+
+# HS256 tokens are verified directly with hmac.digest (a single C call);
+# signing, and any other ALGORITHM, goes through PyJWT.
+def _b64url_encode(raw: bytes) -> bytes:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=")
+
+def _b64url_decode(seg: bytes) -> bytes:
+    return base64.urlsafe_b64decode(seg + b"=" * (-len(seg) % 4))
+
+_HS256_HEADER = _b64url_encode(b'{"alg":"HS256","typ":"JWT"}')
+
+def _hs256_decode(token: str) -> dict:
+    try:
+        signing_input, _, sig = token.encode().rpartition(b".")
+        header, _, payload = signing_input.partition(b".")
+        if header != _HS256_HEADER:
+            # not one of ours (different header encoding) → let PyJWT decide
+            return jwt.decode(token, _SIGNING_KEY, algorithms=["HS256"])
+        expected = hmac.digest(_SIGNING_KEY, signing_input, "sha256")
+        if not hmac.compare_digest(expected, _b64url_decode(sig)):
+            raise jwt.InvalidSignatureError("Signature verification failed")
+        claims = json.loads(_b64url_decode(payload))
+        if not isinstance(claims, dict):
+            raise jwt.DecodeError("Invalid payload")
+        exp = claims.get("exp")
+        exp = int(exp) if exp is not None else None
+    except (ValueError, TypeError) as e:
+        raise jwt.DecodeError(str(e))
+    if exp is not None and exp <= time.time():
+        raise jwt.ExpiredSignatureError("Signature has expired")
+    return claims
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -34,12 +118,38 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, _SIGNING_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def decode_access_token(token: str) -> dict:
+    """Verify signature/expiry and return the claims; raises JWTError."""
+    if ALGORITHM == "HS256":
+        return _hs256_decode(token)
+    return jwt.decode(token, _SIGNING_KEY, algorithms=[ALGORITHM])
+
+# Short-lived user lookup cache. Misses (None) are cached too so repeated
+# probes for unknown usernames don't each cost a DB round trip. Anything
+# that writes a user document must call invalidate_user_cache(username).
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 5  # seconds
+_user_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+def invalidate_user_cache(username: str) -> None:
+    _user_cache.pop(username, None)
+
 async def get_user_by_username(username: str):
-    db = get_database()
+    now = time.monotonic()
+    hit = _user_cache.get(username)
+    if hit is not None and hit[0] > now:
+        _user_cache.move_to_end(username)
+        return hit[1]
+
+    db = get_async_database()
     user = await db.users.find_one({"username": username})
+    _user_cache[username] = (now + USER_CACHE_TTL, user)
+    _user_cache.move_to_end(username)
+    if len(_user_cache) > USER_CACHE_SIZE:
+        _user_cache.popitem(last=False)
     return user
 
 async def authenticate_user(username: str, password: str):
@@ -54,10 +164,10 @@ async def authenticate_user(username: str, password: str):
 async def get_current_user(request: Request):
     user = request.session.get("user")
     if not user:
-        print("❌ No active session found → User not authenticated")
+        logger.debug("No active session found; user not authenticated")
         raise HTTPException(status_code=401, detail="Not authenticated")
 
-    print(f"✅ User session found → {user['username']} ({user['role']})")
+    logger.debug("User session found: %s (%s)", user["username"], user["role"])
     return user
 
 
@@ -66,13 +176,13 @@ def require_role(role: str):
         user = request.session.get("user")
         
         if not user:
-            print("❌ No session found.")
+            logger.debug("No session found")
             raise HTTPException(status_code=401, detail="Not authenticated")
         
-        print(f"✅ Session found: {user}")  # Log the user session
+        logger.debug("Session found: %s", user)
         
         if user["role"] != role:
-            print(f"❌ User has role {user['role']} but {role} is required")
+            logger.debug("User has role %s but %s is required", user["role"], role)
             raise HTTPException(status_code=403, detail="Not authorized")
         
         return user
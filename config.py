@@ -0,0 +1,34 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+import os
+
+from dotenv import load_dotenv
+
+
+@dataclass(frozen=True)
+class Settings:
+    MONGODB_URL: Optional[str]
+    DATABASE_NAME: Optional[str]
+    SECRET_KEY: str = "medicine123"
+    ALGORITHM: str = "HS256"
+    ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
+    BCRYPT_ROUNDS: int = 12
+    REDIS_URL: Optional[str] = None
+    TEMPLATES_AUTO_RELOAD: bool = False
+
+
+@lru_cache
+def get_settings() -> Settings:
+    """Read .env and the environment once per process."""
+    load_dotenv()
+    return Settings(
+        MONGODB_URL=os.getenv("MONGODB_URL"),
+        DATABASE_NAME=os.getenv("DATABASE_NAME"),
+        SECRET_KEY=os.getenv("SECRET_KEY", "medicine123"),
+        ALGORITHM=os.getenv("ALGORITHM", "HS256"),
+        ACCESS_TOKEN_EXPIRE_MINUTES=int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30")),
+        BCRYPT_ROUNDS=int(os.getenv("BCRYPT_ROUNDS", "12")),
+        REDIS_URL=os.getenv("REDIS_URL"),
+        TEMPLATES_AUTO_RELOAD=os.getenv("TEMPLATES_AUTO_RELOAD", "").lower() in ("1", "true", "yes"),
+    )
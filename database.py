@@ -1,11 +1,18 @@
 from pymongo import MongoClient
-from dotenv import load_dotenv
-import os
+from motor.motor_asyncio import AsyncIOMotorClient
+from config import get_settings
 
-load_dotenv()
+settings = get_settings()
 
-client = MongoClient(os.getenv("MONGODB_URL"))
-db = client[os.getenv("DATABASE_NAME")]
+client = MongoClient(settings.MONGODB_URL)
+db = client[settings.DATABASE_NAME]
+
+# async client for handlers running on the event loop
+async_client = AsyncIOMotorClient(settings.MONGODB_URL, maxPoolSize=50)
+async_db = async_client[settings.DATABASE_NAME]
 
 def get_database():
     return db
+
+def get_async_database():
+    return async_db
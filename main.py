@@ -3,11 +3,13 @@
 
 from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.middleware.sessions import SessionMiddleware
 import os
+import asyncio
+import logging
+import anyio
 
 # ---- route modules ----
 from routes import (
@@ -24,39 +26,150 @@ from routes import (
 
 from routes.init_routes import init_default_users
 
-# ---- db ----
+# ---- db / config ----
 from database import get_database
+from config import get_settings
+from templating import templates, warm_templates
 
 app = FastAPI(title="Medicine Availability Tracker", version="1.0.0")
 
 # ---- static & templates ----
 BASE_DIR = os.path.dirname(__file__)
 app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "static")), name="static")
-templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
+app.state.templates = templates
 
 # ---- session middleware ----
-app.add_middleware(SessionMiddleware, secret_key="supersecretkey")
+# With REDIS_URL set, sessions live in Redis and the cookie only carries a
+# session id; otherwise fall back to the signed-cookie session.
+REDIS_URL = get_settings().REDIS_URL
+if REDIS_URL:
+    from starsessions import SessionAutoloadMiddleware
+    from starsessions import SessionMiddleware as RedisSessionMiddleware
+    from starsessions.stores.redis import RedisStore
+
+    # autoload must sit inside the session middleware, so add it first
+    app.add_middleware(SessionAutoloadMiddleware)
+    app.add_middleware(
+        RedisSessionMiddleware,
+        store=RedisStore(url=REDIS_URL),
+        lifetime=60 * 60 * 24 * 14,
+        cookie_https_only=False,
+    )
+else:
+    app.add_middleware(SessionMiddleware, secret_key="supersecretkey")
 
 # ---- startup ----
-@app.on_event("startup")
-def startup_event():
-    # seed default users/roles
-    init_default_users()
+logger = logging.getLogger("startup")
 
-    # indexes (best-effort)
+def _step(fn, *args, **kwargs):
+    # each index/backfill is independent: log a failure and carry on
     try:
-        db = get_database()
-        # Notifications: user unread recents
-        db.Notifications.create_index([("user_id", 1), ("is_read", 1), ("created_at", -1)])
-        # Orders commonly queried by buyer/seller + recency
-        db.Orders.create_index([("buyer_id", 1), ("created_at", -1)])
-        db.Orders.create_index([("pharmacy_id", 1), ("created_at", -1)])
-        # Medicines availability (optional)
-        db.Medicine.create_index([("stock", -1), ("reserved", -1)])
-        db.Medicine.create_index("expiration_date")
+        fn(*args, **kwargs)
     except Exception:
-        # avoid crashing app on index creation issues
-        pass
+        coll = getattr(getattr(fn, "__self__", None), "name", "?")
+        logger.exception("startup step %s.%s%r failed", coll, getattr(fn, "__name__", fn), args[:1])
+
+def ensure_indexes():
+    # indexes (best-effort, one step at a time)
+    db = get_database()
+    # Notifications: user unread recents
+    _step(db.Notifications.create_index, [("user_id", 1), ("is_read", 1), ("created_at", -1)])
+    # Legacy orders without a stored total: sum their lines once here so
+    # list pages never have to
+    _step(db.Orders.update_many,
+        {"total_amount": {"$exists": False}},
+        [{"$set": {"total_amount": {"$sum": {"$map": {
+            "input": {"$ifNull": ["$items", []]},
+            "as": "it",
+            "in": {"$multiply": [{"$ifNull": ["$$it.price", 0]}, {"$ifNull": ["$$it.quantity", 0]}]},
+        }}}}}],
+    )
+    # Orders commonly queried by buyer/seller + recency
+    _step(db.Orders.create_index, [("buyer_id", 1), ("created_at", -1)])
+    _step(db.Orders.create_index, [("pharmacy_id", 1), ("created_at", -1)])
+    # buyer list filtered by status, sorted by date or total
+    _step(db.Orders.create_index, [("buyer_id", 1), ("order_status", 1), ("created_at", -1)])
+    _step(db.Orders.create_index, [("buyer_id", 1), ("order_status", 1), ("total_amount", -1), ("created_at", -1)])
+    # seller list filtered by order/payment status, newest first
+    _step(db.Orders.create_index, [("pharmacy_id", 1), ("order_status", 1), ("payment_status", 1), ("created_at", -1)])
+    # seller review queue: payment_status $in, newest update first
+    _step(db.Orders.create_index, [("pharmacy_id", 1), ("payment_status", 1), ("updated_at", -1)])
+    # buyer orders search ($text needs the buyer_id equality prefix)
+    _step(db.Orders.create_index,
+        [("buyer_id", 1), ("pharmacy_name", "text"), ("items.medicine_name", "text")],
+        name="buyer_orders_text",
+    )
+    # add_to_cart: the buyer's open order at one pharmacy
+    _step(db.Orders.create_index, [("buyer_id", 1), ("pharmacy_id", 1), ("order_status", 1), ("payment_status", 1)])
+    # Admin top-N: $match on status, $group by buyer/pharmacy
+    _step(db.Orders.create_index, [("status", 1), ("buyer_id", 1)])
+    _step(db.Orders.create_index, [("status", 1), ("pharmacy_id", 1)])
+    # Medicines availability: backfill the derived field, then index it
+    _step(db.Medicine.update_many,
+        {"available": {"$exists": False}},
+        [{"$set": {"available": {"$subtract": ["$stock", {"$ifNull": ["$reserved", 0]}]}}}],
+    )
+    _step(db.Medicine.create_index, [("available", 1), ("expiration_date", 1)])
+    _step(db.Medicine.create_index, "expiration_date")
+    # buyer medicines: $lookup seller_id -> pharmacy_profiles.user_id
+    _step(db.Medicine.create_index, "seller_id")
+    _step(db.pharmacy_profiles.create_index, "user_id")
+    # buyer pharmacies: $geoNear over a GeoJSON location, backfilled from
+    # either coordinates.{latitude,longitude} or top-level latitude/longitude
+    for lat_f, lon_f in (("coordinates.latitude", "coordinates.longitude"), ("latitude", "longitude")):
+        _step(db.pharmacy_profiles.update_many,
+            {"location": {"$exists": False}, lat_f: {"$type": "number"}, lon_f: {"$type": "number"}},
+            [{"$set": {"location": {"type": "Point", "coordinates": ["$" + lon_f, "$" + lat_f]}}}],
+        )
+    _step(db.pharmacy_profiles.create_index, [("location", "2dsphere")])
+    # every buyer page starts with a profile lookup by user_id; seller
+    # order lists resolve buyer names through user_profiles.user_id
+    _step(db.buyer_profiles.create_index, "user_id")
+    _step(db.user_profiles.create_index, "user_id")
+    # Admin dashboards page through profiles newest-first
+    _step(db.buyer_profiles.create_index, [("created_at", -1)])
+    _step(db.pharmacy_profiles.create_index, [("created_at", -1)])
+    # Geocoding cache lookups by normalized address
+    _step(db.geocode_cache.create_index, "address", unique=True)
+    _step(db.geocode_cache.create_index, "ts", expireAfterSeconds=buyer_routes.GEOCODE_TTL)
+
+def seed_notif_counters():
+    # Unread badge counters: seed once from Notifications. After that
+    # create_notification/mark_read keep them exact, so never recount over
+    # live increments.
+    db = get_database()
+    _step(db.NotifCounters.create_index, "user_id", unique=True)
+    if db.NotifCounters.estimated_document_count() == 0:
+        _step(db.Notifications.aggregate, [
+            {"$match": {"is_read": False}},
+            {"$group": {"_id": "$user_id", "unread": {"$sum": 1}}},
+            {"$project": {"_id": 0, "user_id": "$_id", "unread": 1}},
+            {"$merge": {"into": "NotifCounters", "on": "user_id", "whenMatched": "merge", "whenNotMatched": "insert"}},
+        ])
+
+def bootstrap():
+    # seed default users/roles, then build indexes and precompile templates
+    try:
+        init_default_users()
+    finally:
+        ensure_indexes()
+        warm_templates()
+
+@app.on_event("startup")
+async def startup_event():
+    # counters must be seeded before any request can bump them; this is a
+    # no-op once the collection has documents
+    try:
+        await anyio.to_thread.run_sync(seed_notif_counters)
+    except Exception:
+        logger.exception("seeding NotifCounters failed")
+    # run seeding + index builds in a worker thread so the server starts
+    # accepting requests immediately; keep a reference so the task isn't GC'd
+    app.state.bootstrap_task = asyncio.create_task(anyio.to_thread.run_sync(bootstrap))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await buyer_routes.close_geocoder()
 
 # ---- include routers ----
 app.include_router(auth_routes.router)
@@ -78,7 +191,16 @@ async def custom_http_exception_handler(request: Request, exc: StarletteHTTPExce
 
 # ---- dev run ----
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # uvloop has no Windows build; httptools does
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=True,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+    )
 
 
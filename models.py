@@ -2,6 +2,7 @@ from pydantic import BaseModel, Field
 from typing import Optional, List
 from datetime import datetime
 from bson import ObjectId
+from bson.errors import InvalidId
 
 class PyObjectId(ObjectId):
     @classmethod
@@ -10,9 +11,13 @@ class PyObjectId(ObjectId):
 
     @classmethod
     def validate(cls, v):
-        if not ObjectId.is_valid(v):
+        if isinstance(v, ObjectId):
+            return v
+        # parse once; is_valid() + ObjectId() would parse the hex twice
+        try:
+            return ObjectId(v)
+        except (InvalidId, TypeError):
             raise ValueError("Invalid objectid")
-        return ObjectId(v)
 
     @classmethod
     def __get_pydantic_json_schema__(cls, field_schema):
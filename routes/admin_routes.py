@@ -1,27 +1,95 @@
-from fastapi import APIRouter, Request, Depends, Form
+from fastapi import APIRouter, Request, Depends, Form, Query, HTTPException
 from fastapi.responses import HTMLResponse, RedirectResponse
 from bson import ObjectId
+from bson.errors import InvalidId
+from functools import lru_cache
+import asyncio
+import time
 
-from database import get_database
+from database import get_async_database
 from auth import require_role
-from fastapi.templating import Jinja2Templates
+from templating import templates
 
-templates = Jinja2Templates(directory="templates")
 router = APIRouter()
 
+# compiled once at import instead of looked up on every request
+CUSTOMERS_TPL = templates.get_template("customer_dashboard_admin.html")
+PHARMACIES_TPL = templates.get_template("pharmacies_dashboard_admin.html")
+ADMIN_DASHBOARD_TPL = templates.get_template("admin_dashboard.html")
+
+PAGE_SIZE = 50
+COUNT_TTL = 30  # seconds
+
+# Only the fields the admin templates render
+BUYER_FIELDS = {"name": 1, "address": 1, "user_id": 1, "created_at": 1, "is_profile_complete": 1}
+PHARMACY_FIELDS = {"pharmacy_name": 1, "license_number": 1, "contact_info": 1, "address": 1,
+                   "operating_hours": 1, "created_at": 1}
+
+
+@lru_cache(maxsize=4096)
+def _parse_oid(value: str) -> ObjectId:
+    return ObjectId(value)
+
+
+def _oid_or_422(value: str) -> ObjectId:
+    try:
+        return _parse_oid(value)
+    except (InvalidId, TypeError):
+        raise HTTPException(status_code=422, detail="Invalid id")
+
+
+# path converters: reject malformed ids before the handler touches the DB
+def user_oid(user_id: str) -> ObjectId:
+    return _oid_or_422(user_id)
+
+
+def pharmacy_oid(pharmacy_id: str) -> ObjectId:
+    return _oid_or_422(pharmacy_id)
+
+
+_count_cache: dict = {}
+
+
+async def _profile_counts(db) -> tuple:
+    """(buyers, pharmacies) from collection metadata, cached for COUNT_TTL seconds."""
+    now = time.monotonic()
+    cached = _count_cache.get("profiles")
+    if cached and cached[0] > now:
+        return cached[1]
+    counts = tuple(await asyncio.gather(
+        db.buyer_profiles.estimated_document_count(),
+        db.pharmacy_profiles.estimated_document_count(),
+    ))
+    _count_cache["profiles"] = (now + COUNT_TTL, counts)
+    return counts
+
+
+async def _paginate(collection, page: int, size: int, projection: dict):
+    """Return (one page of docs newest-first, total count) using two concurrent queries."""
+    cursor = collection.find({}, projection).sort("created_at", -1).skip((page - 1) * size).limit(size)
+    return await asyncio.gather(cursor.to_list(length=size), collection.count_documents({}))
+
 
 @router.get("/admin/customers", response_class=HTMLResponse)
-def customers_dashboard(request: Request, current_user: dict = Depends(require_role("admin"))):
-    db = get_database()
+async def customers_dashboard(
+    request: Request,
+    page: int = Query(1, ge=1),
+    size: int = Query(PAGE_SIZE, ge=1, le=200, alias="page_size"),
+    current_user: dict = Depends(require_role("admin")),
+):
+    db = get_async_database()
 
-    buyers = list(db.buyer_profiles.find({}))
+    buyers, buyer_count = await _paginate(db.buyer_profiles, page, size, BUYER_FIELDS)
 
-    # Top 3 most active customers
-    top_customers = list(db.Orders.aggregate([
+    # Top 3 most active customers ($topN keeps a bounded heap instead of sorting every group)
+    top_customers = await db.Orders.aggregate([
         {"$match": {"status": "delivered"}},
         {"$group": {"_id": "$buyer_id", "totalOrders": {"$sum": 1}}},
-        {"$sort": {"totalOrders": -1}},
-        {"$limit": 3},
+        {"$group": {"_id": None, "top": {"$topN": {
+            "n": 3, "sortBy": {"totalOrders": -1}, "output": {"_id": "$_id", "totalOrders": "$totalOrders"}
+        }}}},
+        {"$unwind": "$top"},
+        {"$replaceRoot": {"newRoot": "$top"}},
         {
             "$lookup": {
                 "from": "buyer_profiles",
@@ -32,28 +100,40 @@ def customers_dashboard(request: Request, current_user: dict = Depends(require_r
         },
         {"$unwind": "$buyer"},
         {"$project": {"_id": 0, "buyerName": "$buyer.name", "totalOrders": 1}}
-    ]))
+    ]).to_list(length=3)
 
-    return templates.TemplateResponse("customer_dashboard_admin.html", {
+    return HTMLResponse(CUSTOMERS_TPL.render({
         "request": request,
         "buyers": buyers,
+        "buyer_count": buyer_count,
+        "page": page,
+        "size": size,
+        "has_next": page * size < buyer_count,
         "top_customers": top_customers,
         "current_user": current_user
-    })
+    }))
 
 
 @router.get("/admin/pharmacies", response_class=HTMLResponse)
-def pharmacies_dashboard(request: Request, current_user: dict = Depends(require_role("admin"))):
-    db = get_database()
+async def pharmacies_dashboard(
+    request: Request,
+    page: int = Query(1, ge=1),
+    size: int = Query(PAGE_SIZE, ge=1, le=200, alias="page_size"),
+    current_user: dict = Depends(require_role("admin")),
+):
+    db = get_async_database()
     
-    pharmacies = list(db.pharmacy_profiles.find({}))
+    pharmacies, pharmacy_count = await _paginate(db.pharmacy_profiles, page, size, PHARMACY_FIELDS)
 
     # Top 3 best-selling pharmacies (same structure as top_customers)
-    top_pharmacies = list(db.Orders.aggregate([
+    top_pharmacies = await db.Orders.aggregate([
         {"$match": {"status": "delivered"}},
         {"$group": {"_id": "$pharmacy_id", "totalSales": {"$sum": 1}}},
-        {"$sort": {"totalSales": -1}},
-        {"$limit": 3},
+        {"$group": {"_id": None, "top": {"$topN": {
+            "n": 3, "sortBy": {"totalSales": -1}, "output": {"_id": "$_id", "totalSales": "$totalSales"}
+        }}}},
+        {"$unwind": "$top"},
+        {"$replaceRoot": {"newRoot": "$top"}},
         {
             "$lookup": {
                 "from": "pharmacy_profiles",
@@ -64,39 +144,58 @@ def pharmacies_dashboard(request: Request, current_user: dict = Depends(require_
         },
         {"$unwind": "$pharmacy"},
         {"$project": {"_id": 0, "pharmacyName": "$pharmacy.pharmacy_name", "totalSales": 1}}
-    ]))
+    ]).to_list(length=3)
 
-    return templates.TemplateResponse("pharmacies_dashboard_admin.html", {
+    return HTMLResponse(PHARMACIES_TPL.render({
         "request": request,
         "pharmacies": pharmacies,
+        "pharmacy_count": pharmacy_count,
+        "page": page,
+        "size": size,
+        "has_next": page * size < pharmacy_count,
         "top_pharmacies": top_pharmacies,
         "current_user": current_user
-    })
+    }))
 
 
 @router.get("/admin/dashboard", response_class=HTMLResponse)
-def admin_dashboard(request: Request, current_user: dict = Depends(require_role("admin"))):
-    db = get_database()
-
-    buyers = list(db.buyer_profiles.find({}))
-    pharmacies = list(db.pharmacy_profiles.find({}))
+async def admin_dashboard(
+    request: Request,
+    page: int = Query(1, ge=1),
+    size: int = Query(PAGE_SIZE, ge=1, le=200, alias="page_size"),
+    current_user: dict = Depends(require_role("admin")),
+):
+    db = get_async_database()
+
+    # A page of each collection, each read off its created_at index, run
+    # concurrently. Counts come from cached metadata.
+    skip = (page - 1) * size
+    buyers, pharmacies, (buyer_count, pharmacy_count) = await asyncio.gather(
+        db.buyer_profiles.find({}, BUYER_FIELDS).sort("created_at", -1).skip(skip).limit(size).to_list(length=size),
+        db.pharmacy_profiles.find({}, PHARMACY_FIELDS).sort("created_at", -1).skip(skip).limit(size).to_list(length=size),
+        _profile_counts(db),
+    )
 
-    total_users = len(buyers) + len(pharmacies)
+    total_users = buyer_count + pharmacy_count
 
-    return templates.TemplateResponse("admin_dashboard.html", {
+    return HTMLResponse(ADMIN_DASHBOARD_TPL.render({
         "request": request,
         "buyers": buyers,
         "pharmacies": pharmacies,
+        "buyer_count": buyer_count,
+        "pharmacy_count": pharmacy_count,
+        "page": page,
+        "size": size,
+        "has_next": page * size < max(buyer_count, pharmacy_count),
         "total_users": total_users,
         "current_user": current_user
-    })
+    }))
 
 
 @router.post("/admin/remove_user/{user_id}")
-async def remove_user(user_id: str, request: Request):
-    db = get_database()
-    # Convert string back to ObjectId
-    result = db.buyers.delete_one({"_id": ObjectId(user_id)})
+async def remove_user(request: Request, user_id: ObjectId = Depends(user_oid)):
+    db = get_async_database()
+    result = await db.buyers.delete_one({"_id": user_id})
     if result.deleted_count == 1:
         print("Deleted successfully")
     else:
@@ -107,21 +206,24 @@ async def remove_user(user_id: str, request: Request):
 
 
 @router.post("/admin/remove_pharmacy/{pharmacy_id}")
-def remove_pharmacy(
-    pharmacy_id: str,
+async def remove_pharmacy(
+    oid: ObjectId = Depends(pharmacy_oid),
     next: str = Form(...),
     current_user: dict = Depends(require_role("admin"))
 ):
-    db = get_database()
-    oid = ObjectId(pharmacy_id)
-
-    db.pharmacy_profiles.delete_one({"_id": oid})
-
-    db.buyer_profiles.update_many(
-        {"favorite_pharmacies": oid},
-        {"$pull": {"favorite_pharmacies": oid}}
+    db = get_async_database()
+
+    # different collections, so the delete and the favourites cascade can run concurrently
+    await asyncio.gather(
+        db.pharmacy_profiles.delete_one({"_id": oid}),
+        db.buyer_profiles.update_many(
+            {"favorite_pharmacies": oid},
+            {"$pull": {"favorite_pharmacies": oid}}
+        ),
     )
 
+    _count_cache.clear()
+
     redirect_map = {
         "admin_dashboard": "/admin/dashboard",
         "pharmacies_dashboard_admin": "/admin/pharmacies"
@@ -1,17 +1,13 @@
 from fastapi import APIRouter, Request, Form, Depends
 from fastapi.responses import RedirectResponse
-from fastapi.templating import Jinja2Templates
+from templating import templates
 from datetime import timedelta
-from jose import jwt, JWTError
 
-from auth import verify_password, create_access_token
+from auth import verify_password, create_access_token, decode_access_token, JWTError
 from database import db  # your MongoDB connection
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
 
-SECRET_KEY = "your_secret_key"
-ALGORITHM = "HS256"
 @router.get("/login")
 def login_page(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
@@ -25,7 +21,7 @@ def route_redirector(request: Request):
     
     try:
         scheme, _, param = token.partition(" ")
-        payload = jwt.decode(param, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_access_token(param)
         username = payload.get("sub")
         user = db["users"].find_one({"username": username})
         if not user:
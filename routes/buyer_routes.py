@@ -1,39 +1,123 @@
-from fastapi import APIRouter, Request, Depends, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import APIRouter, Request, Depends, Form, BackgroundTasks
+from fastapi.responses import HTMLResponse, RedirectResponse, ORJSONResponse
 from datetime import datetime
-from database import get_database
+from database import get_async_database
 from auth import require_role
-from bson import ObjectId
-from utils import format_currency, equirectangular_distance
-from fastapi.templating import Jinja2Templates
-import requests
+from pymongo import ReturnDocument
+from utils import geo_point
+from templating import templates
+from collections import OrderedDict
+import asyncio
+import httpx
+import logging
+import re
+import time
 
 router = APIRouter()
-
-# Initialize templates
-templates = Jinja2Templates(directory="templates")
+logger = logging.getLogger("buyer")
+
+# Only the fields the buyer pages actually render
+MEDICINE_FIELDS = {
+    "name": 1, "selling_price": 1, "available": 1, "description": 1,
+    "expiration_date": 1, "seller_id": 1, "image_filename": 1,
+}
+PHARMACY_FIELDS = {
+    "_id": 0, "user_id": 1, "pharmacy_name": 1, "address": 1, "license_number": 1,
+    "contact_info": 1, "operating_hours": 1,
+}
 
 # -----------------------------
 # Utility: Geocoding
 # -----------------------------
-def geocode_address(address: str):
-    """
-    Use OpenStreetMap Nominatim API to convert address -> (lat, lon).
-    """
+# Shared client so connections to Nominatim are reused across requests;
+# closed from the app shutdown hook via close_geocoder().
+_geo_client = httpx.AsyncClient(headers={"User-Agent": "medicine-tracker-app"}, timeout=5.0)
+
+
+async def close_geocoder():
+    await _geo_client.aclose()
+
+
+# Geocode results keyed by normalized address: in-process LRU first, then the
+# geocode_cache collection (shared across workers, entries expire after
+# GEOCODE_TTL via a TTL index), then Nominatim. Failed lookups are remembered
+# in-process for GEOCODE_MISS_TTL so a bad address isn't re-sent every save.
+GEOCODE_CACHE_SIZE = 4096
+GEOCODE_TTL = 48 * 3600
+GEOCODE_MISS_TTL = 600
+_geocode_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_geocode_misses: "OrderedDict[str, float]" = OrderedDict()
+
+
+def _normalize_address(address: str) -> str:
+    return " ".join(address.lower().split())
+
+
+def _remember_geocode(key: str, coords: tuple):
+    _geocode_cache[key] = coords
+    _geocode_cache.move_to_end(key)
+    if len(_geocode_cache) > GEOCODE_CACHE_SIZE:
+        _geocode_cache.popitem(last=False)
+
+
+def _remember_miss(key: str):
+    _geocode_misses[key] = time.monotonic() + GEOCODE_MISS_TTL
+    _geocode_misses.move_to_end(key)
+    if len(_geocode_misses) > GEOCODE_CACHE_SIZE:
+        _geocode_misses.popitem(last=False)
+
+
+async def _geocode_remote(address: str):
     url = "https://nominatim.openstreetmap.org/search"
     params = {"q": address, "format": "json", "limit": 1}
-    headers = {"User-Agent": "medicine-tracker-app"}
     try:
-        r = requests.get(url, params=params, headers=headers, timeout=5)
+        r = await _geo_client.get(url, params=params)
         data = r.json()
         if data:
             return float(data[0]["lat"]), float(data[0]["lon"])
     except Exception as e:
-        print(f"⚠️ Geocoding failed for {address}: {e}")
+        logger.warning("Geocoding failed for %r: %s", address, e)
     return None, None
 
 
-def get_buyer_coordinates(db, buyer_profile, force_update=False):
+async def geocode_address(address: str):
+    """
+    Use OpenStreetMap Nominatim API to convert address -> (lat, lon).
+    Successful lookups are cached for GEOCODE_TTL; failures only for
+    GEOCODE_MISS_TTL, so they get retried later.
+    """
+    key = _normalize_address(address)
+    coords = _geocode_cache.get(key)
+    if coords is not None:
+        _geocode_cache.move_to_end(key)
+        return coords
+    retry_at = _geocode_misses.get(key)
+    if retry_at is not None:
+        if time.monotonic() < retry_at:
+            return None, None
+        del _geocode_misses[key]
+
+    db = get_async_database()
+    doc = await db.geocode_cache.find_one({"address": key}, {"lat": 1, "lon": 1})
+    if doc:
+        coords = (doc["lat"], doc["lon"])
+        _remember_geocode(key, coords)
+        return coords
+
+    lat, lon = await _geocode_remote(address)
+    if lat is not None and lon is not None:
+        _remember_geocode(key, (lat, lon))
+        await db.geocode_cache.update_one(
+            {"address": key},
+            {"$set": {"lat": lat, "lon": lon, "ts": datetime.utcnow()}},
+            upsert=True,
+        )
+    else:
+        _remember_miss(key)
+    return lat, lon
+
+
+async def get_buyer_coordinates(db, buyer_profile, force_update=False):
     """
     Return buyer coordinates.
     - If already present and force_update=False → return them
@@ -45,9 +129,9 @@ def get_buyer_coordinates(db, buyer_profile, force_update=False):
 
     address = buyer_profile.get("address")
     if address:
-        lat, lon = geocode_address(address)
+        lat, lon = await geocode_address(address)
         if lat is not None and lon is not None:
-            db.buyer_profiles.update_one(
+            await db.buyer_profiles.update_one(
                 {"_id": buyer_profile["_id"]},
                 {"$set": {"coordinates": {"latitude": lat, "longitude": lon}}}
             )
@@ -59,14 +143,15 @@ def get_buyer_coordinates(db, buyer_profile, force_update=False):
 # Buyer Home
 # -----------------------------
 @router.get("/buyer/home", response_class=HTMLResponse)
-def buyer_home(request: Request, current_user: dict = Depends(require_role("buyer"))):
-    db = get_database()
+async def buyer_home(request: Request, current_user: dict = Depends(require_role("buyer"))):
+    db = get_async_database()
 
     # Fetch buyer profile
-    buyer_profile = db.buyer_profiles.find_one({"user_id": current_user["id"]})
+    # home only needs to know the profile exists
+    buyer_profile = await db.buyer_profiles.find_one({"user_id": current_user["id"]}, {"_id": 1})
 
     if not buyer_profile:
-        print(f"❌ No profile found for user {current_user['username']}. Redirecting to profile creation.")
+        logger.debug("No buyer profile for %s, redirecting to profile edit", current_user["username"])
         return RedirectResponse(url="/buyer/profile-edit", status_code=302)
 
     return templates.TemplateResponse("buyer/home.html", {
@@ -79,100 +164,141 @@ def buyer_home(request: Request, current_user: dict = Depends(require_role("buye
 # -----------------------------
 # Medicines
 # -----------------------------
-@router.get("/buyer/medicines", response_class=HTMLResponse)
-async def buyer_medicines(request: Request, current_user: dict = Depends(require_role("buyer"))):
-    db = get_database()
-
-    # availability: stock - reserved > 0
-    cur = db.Medicine.find({
-        "$expr": {"$gt": [
-            {"$subtract": ["$stock", {"$ifNull": ["$reserved", 0]}]},
-            0
-        ]},
-        "$or": [
-            {"expiration_date": {"$exists": False}},
-            {"expiration_date": {"$gte": datetime.utcnow()}}
-        ]
-    })
+async def _available_medicines(db) -> list:
+    """In-stock, unexpired medicines shaped exactly as the buyer grid reads them."""
+    # expiry is a calendar date (stored at midnight): a medicine is still
+    # listed on its expiration day, matching the seller inventory view
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    # available (= stock - reserved, kept up to date on writes) > 0;
+    # pharmacy name joined server-side
+    return await db.Medicine.aggregate([
+        {"$match": {
+            "available": {"$gt": 0},
+            "$or": [
+                {"expiration_date": {"$exists": False}},
+                {"expiration_date": {"$gte": today}}
+            ]
+        }},
+        {"$project": MEDICINE_FIELDS},
+        {"$lookup": {
+            "from": "pharmacy_profiles",
+            "localField": "seller_id",
+            "foreignField": "user_id",
+            "pipeline": [{"$limit": 1}, {"$project": {"_id": 0, "pharmacy_name": 1}}],
+            "as": "pharm"
+        }},
+        # shape rows exactly as the client-side grid reads them
+        {"$project": {
+            "_id": {"$toString": "$_id"},
+            "name": 1,
+            "description": 1,
+            "selling_price": {"$ifNull": ["$selling_price", 0]},
+            "available": {"$max": [0, "$available"]},
+            "is_expired": {"$lt": [{"$ifNull": ["$expiration_date", today]}, today]},
+            "expiration_date": {"$dateToString": {"format": "%Y-%m-%d", "date": "$expiration_date"}},
+            "image_url": {"$cond": [
+                {"$gt": [{"$strLenCP": {"$ifNull": ["$image_filename", ""]}}, 0]},
+                {"$concat": ["/static/images/medicines/", "$image_filename"]},
+                None,
+            ]},
+            "pharmacy_name": {"$ifNull": [{"$arrayElemAt": ["$pharm.pharmacy_name", 0]}, "Unknown Pharmacy"]},
+        }},
+    ]).to_list(length=None)
 
-    meds = list(cur)
-    medicines_data = []
-    for med in meds:
-        stock = int(med.get("stock", 0) or 0)
-        reserved = int(med.get("reserved", 0) or 0)
-        available = max(0, stock - reserved)
-
-        pharmacy = db.pharmacy_profiles.find_one({"user_id": med.get("seller_id")})
-        medicines_data.append({
-            "_id": str(med["_id"]),
-            "name": med.get("name"),
-            "buying_price": med.get("buying_price"),
-            "selling_price": med.get("selling_price"),
-            "stock": stock,
-            "reserved": reserved,
-            "available": available,
-            "description": med.get("description"),
-            "formatted_price": format_currency(med.get("selling_price", 0)),
-            "is_expired": bool(med.get("expiration_date") and med["expiration_date"] < datetime.utcnow()),
-            "expiration_date": (med.get("expiration_date").strftime("%Y-%m-%d") if med.get("expiration_date") else None),
-            "pharmacy_name": (pharmacy.get("pharmacy_name") if pharmacy else "Unknown Pharmacy"),
-            "image_url": (f"/static/images/medicines/{med.get('image_filename')}" if med.get("image_filename") else None),
-        })
-
-    available_count = sum(1 for m in medicines_data if (m["available"] or 0) > 0)
 
+@router.get("/buyer/medicines", response_class=HTMLResponse)
+async def buyer_medicines(request: Request, current_user: dict = Depends(require_role("buyer"))):
+    # HTML shell only; the grid is rendered client-side from /buyer/medicines.json
     return templates.TemplateResponse(
         "buyer/medicines.html",
-        {
-            "request": request,
-            "current_user": current_user,
-            "medicines": medicines_data,
-            "available_count": available_count,
-        },
+        {"request": request, "current_user": current_user},
     )
 
 
+@router.get("/buyer/medicines.json", response_class=ORJSONResponse)
+async def buyer_medicines_json(current_user: dict = Depends(require_role("buyer"))):
+    medicines = await _available_medicines(get_async_database())
+    return ORJSONResponse({"medicines": medicines})
+
+
 # -----------------------------
 # Pharmacies (Sorted by Distance)
 # -----------------------------
+# Medicine counts per seller are the same for every buyer and only drift as
+# sellers edit inventory, so the grouped scan is shared for COUNT_TTL seconds.
+COUNT_TTL = 30  # seconds
+_count_cache: dict = {}
+
+# Cap on ranked results; the page is a browse list, nobody scrolls past this
+NEARBY_LIMIT = 200
+
+
+async def _medicine_counts(db) -> dict:
+    """{seller_id: medicine count}, cached for COUNT_TTL seconds."""
+    now = time.monotonic()
+    cached = _count_cache.get("medicines")
+    if cached and cached[0] > now:
+        return cached[1]
+    counts = {
+        d["_id"]: d["count"]
+        async for d in db.Medicine.aggregate([
+            {"$group": {"_id": "$seller_id", "count": {"$sum": 1}}},
+        ])
+    }
+    _count_cache["medicines"] = (now + COUNT_TTL, counts)
+    return counts
+
+
 @router.get("/buyer/pharmacies", response_class=HTMLResponse)
-def buyer_pharmacies(request: Request, current_user: dict = Depends(require_role("buyer"))):
-    db = get_database()
-    buyer_profile = db.buyer_profiles.find_one({"user_id": current_user["id"]})
+async def buyer_pharmacies(request: Request, current_user: dict = Depends(require_role("buyer"))):
+    db = get_async_database()
+
+    # Profile and per-seller medicine counts are independent
+    buyer_profile, medicine_counts = await asyncio.gather(
+        db.buyer_profiles.find_one({"user_id": current_user["id"]}, {"address": 1, "coordinates": 1}),
+        _medicine_counts(db),
+    )
     if not buyer_profile:
         return RedirectResponse(url="/buyer/profile-edit", status_code=302)
 
     # Ensure buyer has coordinates
-    user_lat, user_lon = get_buyer_coordinates(db, buyer_profile)
+    user_lat, user_lon = await get_buyer_coordinates(db, buyer_profile)
 
-    pharmacies = list(db.pharmacy_profiles.find({}))
+    # Optional search query, matched case-insensitively on name or address
+    match = {}
+    q = request.query_params.get("q", "").strip()
+    if q:
+        pattern = {"$regex": re.escape(q), "$options": "i"}
+        match = {"$or": [{"pharmacy_name": pattern}, {"address": pattern}]}
+
+    if user_lat is not None and user_lon is not None:
+        # Nearest NEARBY_LIMIT via the 2dsphere index (distance in km);
+        # pharmacies without a location can't be ranked and are listed after them
+        nearby, unlocated = await asyncio.gather(
+            db.pharmacy_profiles.aggregate([
+                {"$geoNear": {
+                    "near": geo_point(user_lat, user_lon),
+                    "key": "location",
+                    "query": match,
+                    "distanceField": "distance",
+                    "distanceMultiplier": 0.001,
+                    "spherical": True,
+                }},
+                {"$limit": NEARBY_LIMIT},
+                {"$project": {**PHARMACY_FIELDS, "distance": 1}},
+            ]).to_list(length=None),
+            db.pharmacy_profiles.find({**match, "location": {"$exists": False}}, PHARMACY_FIELDS).to_list(length=None),
+        )
+        pharmacies = nearby + unlocated
+    else:
+        pharmacies = await db.pharmacy_profiles.find(match, PHARMACY_FIELDS).to_list(length=None)
 
     for p in pharmacies:
         # Ensure required fields exist
         p["user_id"] = p.get("user_id", "")
-        # Dynamically count medicines for this pharmacy
-        p["medicine_count"] = db.Medicine.count_documents({"seller_id": p["user_id"]})
-
-        coords = p.get("coordinates", {})
-        plat = coords.get("latitude")
-        plon = coords.get("longitude")
-
-        # Calculate distance safely
-        if user_lat is not None and user_lon is not None and plat is not None and plon is not None:
-            try:
-                p["distance"] = equirectangular_distance(user_lat, user_lon, float(plat), float(plon))
-            except Exception:
-                p["distance"] = None
-        else:
-            p["distance"] = None  # None indicates distance not available
-
-    # Sort by distance if coordinates exist
-    pharmacies.sort(key=lambda x: (x["distance"] is None, x["distance"] or 0))
-
-    # Optional search query
-    q = request.query_params.get("q", "").lower()
-    if q:
-        pharmacies = [p for p in pharmacies if q in p.get("pharmacy_name", "").lower() or q in p.get("address", "").lower()]
+        p["medicine_count"] = medicine_counts.get(p["user_id"], 0)
+        p.setdefault("distance", None)  # None indicates distance not available
 
     return templates.TemplateResponse("buyer/pharmacies.html", {
         "request": request,
@@ -184,27 +310,28 @@ def buyer_pharmacies(request: Request, current_user: dict = Depends(require_role
 # -----------------------------
 # API: Medicines per Pharmacy
 # -----------------------------
-@router.get("/api/pharmacy/{pharmacy_id}/medicines")
-def get_pharmacy_medicines(pharmacy_id: str):
-    db = get_database()
-    meds = list(db.Medicine.find({"seller_id": pharmacy_id}))
-    result = []
-    for med in meds:
-        result.append({
-            "name": med.get("name"),
-            "price": med.get("selling_price", 0),
-            "stock": med.get("stock", 0)
-        })
-    return result
+@router.get("/api/pharmacy/{pharmacy_id}/medicines", response_class=ORJSONResponse)
+async def get_pharmacy_medicines(pharmacy_id: str):
+    db = get_async_database()
+    meds = await db.Medicine.aggregate([
+        {"$match": {"seller_id": pharmacy_id}},
+        {"$project": {
+            "_id": 0,
+            "name": 1,
+            "price": {"$ifNull": ["$selling_price", 0]},
+            "stock": {"$ifNull": ["$stock", 0]},
+        }},
+    ]).to_list(length=None)
+    return ORJSONResponse(meds)
 
 
 # -----------------------------
 # Profile Edit + Update
 # -----------------------------
 @router.get("/buyer/profile-edit", response_class=HTMLResponse)
-def buyer_profile_edit(request: Request, current_user: dict = Depends(require_role("buyer"))):
-    db = get_database()
-    profile = db.buyer_profiles.find_one({"user_id": current_user["id"]})
+async def buyer_profile_edit(request: Request, current_user: dict = Depends(require_role("buyer"))):
+    db = get_async_database()
+    profile = await db.buyer_profiles.find_one({"user_id": current_user["id"]})
     return templates.TemplateResponse("buyer/profile_edit.html", {
         "request": request,
         "current_user": current_user,
@@ -213,8 +340,9 @@ def buyer_profile_edit(request: Request, current_user: dict = Depends(require_ro
 
 
 @router.post("/buyer/profile/update")
-def update_buyer_profile(
+async def update_buyer_profile(
     request: Request,
+    background_tasks: BackgroundTasks,
     name: str = Form(...),
     age: int = Form(...),
     address: str = Form(...),
@@ -222,7 +350,7 @@ def update_buyer_profile(
     email: str = Form(""),
     current_user: dict = Depends(require_role("buyer"))
 ):
-    db = get_database()
+    db = get_async_database()
     
     update_data = {
         "name": name,
@@ -235,12 +363,17 @@ def update_buyer_profile(
     if email:
         update_data["email"] = email
 
-    db.buyer_profiles.update_one({"user_id": current_user["id"]}, {"$set": update_data})
+    # Update in one round trip, keeping the previous address for comparison
+    previous = await db.buyer_profiles.find_one_and_update(
+        {"user_id": current_user["id"]},
+        {"$set": update_data},
+        return_document=ReturnDocument.BEFORE,
+    )
 
-    # Fetch the updated profile
-    buyer_profile = db.buyer_profiles.find_one({"user_id": current_user["id"]})
-    
-    # ⚡ Force update coordinates if address changed
-    get_buyer_coordinates(db, buyer_profile, force_update=True)
+    # ⚡ Re-geocode only when the address actually changed, and after the
+    # response is sent so the redirect doesn't wait on Nominatim
+    if previous and _normalize_address(previous.get("address") or "") != _normalize_address(address):
+        buyer_profile = {**previous, **update_data}
+        background_tasks.add_task(get_buyer_coordinates, db, buyer_profile, force_update=True)
 
     return RedirectResponse(url="/buyer/home", status_code=302)
@@ -1,7 +1,7 @@
 # routes/init_routes.py
 
 from database import get_database
-from auth import hash_password
+from auth import get_password_hash, invalidate_user_cache
 
 # This function will run at startup to ensure at least one admin exists
 def init_default_users():
@@ -11,6 +11,7 @@ def init_default_users():
     if not existing_admin:
         db.users.insert_one({
             "username": "admin",
-            "password": hash_password("admin123"),  # Default password
+            "password": get_password_hash("admin123"),  # Default password
             "role": "admin"
         })
+        invalidate_user_cache("admin")
@@ -1,14 +1,13 @@
 # routes/notification_routes.py
 
 from fastapi import APIRouter, Depends, Query, Request, HTTPException
-from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 from datetime import datetime, timezone
 from bson import ObjectId
+import re
 from database import get_database
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
 
 def _now():
     return datetime.now(timezone.utc)
@@ -23,37 +22,47 @@ def require_user(request: Request):
 @router.get("/notifications/unread_count")
 def notif_unread_count(current_user: dict = Depends(require_user)):
     db = get_database()
-    n = db.Notifications.count_documents({"user_id": current_user["id"], "is_read": False})
-    return {"unread": int(n)}
+    # running counter maintained by create_notification / mark_read
+    doc = db.NotifCounters.find_one({"user_id": current_user["id"]}, {"unread": 1})
+    return {"unread": max(0, int(doc["unread"])) if doc else 0}
 
 
 @router.get("/notifications/list")
 def notif_list(limit: int = Query(20, ge=1, le=100), current_user: dict = Depends(require_user)):
     db = get_database()
-    cur = db.Notifications.find({"user_id": current_user["id"]}).sort("created_at", -1).limit(limit)
-    items = []
-    for d in cur:
-        ts = d.get("created_at")
-        items.append({
-            "id": str(d["_id"]),
-            "type": d.get("type"),
-            "title": d.get("title"),
-            "message": d.get("message"),
-            "order_id": d.get("order_id"),
-            "is_read": bool(d.get("is_read")),
-            # keep iso if you like, but add ms epoch:
-            "created_at_ms": int(ts.replace(tzinfo=timezone.utc).timestamp() * 1000) if ts else None,
-        })
+    # rows come back exactly as the client reads them, epoch ms computed server-side
+    items = list(db.Notifications.aggregate([
+        {"$match": {"user_id": current_user["id"]}},
+        {"$sort": {"created_at": -1}},
+        {"$limit": limit},
+        {"$project": {
+            "_id": 0,
+            "id": {"$toString": "$_id"},
+            "type": 1,
+            "title": 1,
+            "message": 1,
+            "order_id": 1,
+            "is_read": {"$toBool": {"$ifNull": ["$is_read", False]}},
+            "created_at_ms": {"$toLong": "$created_at"},
+        }},
+    ]))
     return {"items": items}
 
 class MarkReq(BaseModel):
     ids: list[str] | None = None  # if None, mark all
 
+MARK_READ_MAX_IDS = 500
+_HEX24 = re.compile(r"^[0-9a-fA-F]{24}$")
+
 @router.post("/notifications/mark_read")
 def notif_mark_read(payload: MarkReq, current_user: dict = Depends(require_user)):
     db = get_database()
     q = {"user_id": current_user["id"], "is_read": False}
     if payload.ids:
-        q["_id"] = {"$in": [ObjectId(i) for i in payload.ids if i]}
-    db.Notifications.update_many(q, {"$set": {"is_read": True, "read_at": _now()}})
+        # cap the batch and drop malformed ids up front (no per-id try/except);
+        # an all-invalid list matches nothing rather than "mark all"
+        q["_id"] = {"$in": [ObjectId(i) for i in payload.ids[:MARK_READ_MAX_IDS] if _HEX24.match(i)]}
+    res = db.Notifications.update_many(q, {"$set": {"is_read": True, "read_at": _now()}})
+    if res.modified_count:
+        db.NotifCounters.update_one({"user_id": current_user["id"]}, {"$inc": {"unread": -res.modified_count}})
     return {"ok": True}
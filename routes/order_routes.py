@@ -1,30 +1,39 @@
 # routes/order_routes.py
 from __future__ import annotations
 
+import contextlib
 import os
 import re
+import asyncio
 import uuid
 import logging
+import time
+import aiofiles
+from collections import OrderedDict
 from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Optional, Any, Tuple, List, Dict
 from zoneinfo import ZoneInfo
 
 from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure
 from fastapi import (
     APIRouter,
     Request,
+    BackgroundTasks,
     Depends,
     Form,
     HTTPException,
     UploadFile,
     File,
 )
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel, ValidationError
+from templating import templates
 
 from auth import require_role
-from database import get_database
+from database import get_async_database
 from utils import format_currency
 
 # -------------------- logging --------------------
@@ -33,26 +42,76 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name
 
 # -------------------- fastapi --------------------
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
+
+# Orders fields each page actually renders; timeline grows with every audit
+# entry and is never shown, so list/detail reads leave it on the server
+BUYER_LIST_FIELDS = {
+    "created_at": 1, "order_status": 1, "status": 1, "payment_status": 1,
+    "items.medicine_name": 1, "items.quantity": 1, "items.price": 1,
+    "pharmacy_name": 1, "pharmacy_id": 1, "seller_id": 1, "formatted_total": 1, "total_amount": 1,
+    "payment.payment_id": 1, "payment.receipt_path": 1, "payment.rejected_reason": 1,
+}
+SELLER_LIST_FIELDS = {
+    "buyer_id": 1, "created_at": 1, "order_status": 1, "status": 1, "payment_status": 1,
+    "items.medicine_name": 1, "items.quantity": 1, "items.price": 1,
+    "formatted_total": 1, "total_amount": 1,
+    "shipping": 1, "shipping_address": 1, "delivery_address": 1,
+}
+REVIEW_FIELDS = {
+    "created_at": 1, "formatted_total": 1, "total_amount": 1,
+    "payment.payment_id": 1, "payment.receipt_path": 1, "payment.rejected_reason": 1,
+}
+NO_TIMELINE = {"timeline": 0}
+BUYER_CONTACT_FIELDS = {"full_name": 1, "name": 1, "phone": 1, "email": 1}
+PAYMENT_PROFILE_FIELDS = {"payment_qr_url": 1, "payment_instructions": 1}
+# audit entries kept per order; $push trims older ones server-side
+TIMELINE_MAX = 200
+# shared stand-in for orders without a payment subdocument; never mutated
+_NO_PAYMENT: dict = {}
+
+# pharmacy names change rarely; remember resolved ones per seller
+PHARMACY_NAME_TTL = 300  # seconds
+PHARMACY_NAME_CACHE_SIZE = 10_000
+_pharmacy_names: "OrderedDict[str, tuple]" = OrderedDict()
+
+# status-filtered buyer lists: the compound index that serves each sort
+# (created_at works in both directions, total_desc matches key for key)
+BUYER_STATUS_HINTS = {
+    "created_desc": [("buyer_id", 1), ("order_status", 1), ("created_at", -1)],
+    "created_asc":  [("buyer_id", 1), ("order_status", 1), ("created_at", -1)],
+    "total_desc":   [("buyer_id", 1), ("order_status", 1), ("total_amount", -1), ("created_at", -1)],
+}
+
+PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+RECEIPT_MAX_BYTES = 10 * 1024 * 1024
+RECEIPT_CHUNK = 1024 * 1024
+RECEIPT_EXTS = frozenset({".jpg", ".jpeg", ".png", ".pdf"})
+# leading bytes of each accepted format -> extensions it may be uploaded as
+_RECEIPT_MAGIC = (
+    (b"\xff\xd8\xff", frozenset({".jpg", ".jpeg"})),
+    (b"\x89PNG", frozenset({".png"})),
+    (b"%PDF", frozenset({".pdf"})),
+)
+
+@lru_cache(maxsize=64)
+def _zi(name: str) -> ZoneInfo:
+    # a handful of zone names cover every user; build each once
+    return ZoneInfo(name)
 
 # jinja filter
 def _fmt_dt_local(dt: Optional[datetime], tz: ZoneInfo | str = "Asia/Yangon") -> str:
     if not dt:
         return "—"
     if isinstance(tz, str):
-        tz = ZoneInfo(tz)
+        tz = _zi(tz)
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(tz).strftime("%Y-%m-%d %H:%M")
+    return f"{dt.astimezone(tz):%Y-%m-%d %H:%M}"
 
 templates.env.filters["fmt_local"] = lambda dt, tz="Asia/Yangon": _fmt_dt_local(dt, tz)
 
-# ======================== MODELS ========================
-
-class AddToCartRequest(BaseModel):
-    medicine_id: str
-    quantity: int
-
 # ======================== HELPERS ========================
 
 def _now() -> datetime:
@@ -63,51 +122,82 @@ def _to_oid(maybe_id):
         return maybe_id
     return ObjectId(str(maybe_id))
 
-def _user_tz(request: Request, db=None, current_user: dict | None = None) -> ZoneInfo:
+async def _user_tz(request: Request, db=None, current_user: dict | None = None) -> ZoneInfo:
     # user -> profile -> session -> default
     if current_user and current_user.get("tz"):
         try:
-            return ZoneInfo(current_user["tz"])
+            return _zi(current_user["tz"])
         except Exception:
             pass
     if db is not None and current_user and current_user.get("id"):
-        prof = db.user_profiles.find_one({"user_id": current_user["id"]}) or {}
+        prof = await db.user_profiles.find_one({"user_id": current_user["id"]}, {"timezone": 1}) or {}
         tzname = prof.get("timezone")
         if tzname:
             try:
-                return ZoneInfo(tzname)
+                return _zi(tzname)
             except Exception:
                 pass
     try:
         tzname = request.session.get("tz")
         if tzname:
-            return ZoneInfo(tzname)
+            return _zi(tzname)
     except Exception:
         pass
-    return ZoneInfo("Asia/Yangon")
+    return _zi("Asia/Yangon")
 
-def _save_receipt(order_id: str, upload: UploadFile) -> str:
+def _page_args(request: Request) -> Tuple[int, int]:
+    """?page= / ?page_size= from the query string, clamped to sane bounds."""
+    try:
+        page = max(1, int(request.query_params.get("page", 1)))
+    except ValueError:
+        page = 1
+    try:
+        size = min(MAX_PAGE_SIZE, max(1, int(request.query_params.get("page_size", PAGE_SIZE))))
+    except ValueError:
+        size = PAGE_SIZE
+    return page, size
+
+async def _fetch_page(cursor, page: int, size: int) -> Tuple[List[dict], bool]:
+    """One page of a sorted cursor plus whether another page follows."""
+    rows = await cursor.skip((page - 1) * size).limit(size + 1).to_list(length=None)
+    return rows[:size], len(rows) > size
+
+async def _save_receipt(order_id: str, upload: UploadFile) -> str:
     ext = os.path.splitext(upload.filename or "")[1].lower()
-    if ext not in [".jpg", ".jpeg", ".png", ".pdf"]:
+    if ext not in RECEIPT_EXTS:
+        raise HTTPException(status_code=400, detail="Only JPG, PNG, PDF allowed")
+    # the filename is user-supplied; make sure the content agrees with it
+    head = await upload.read(4)
+    await upload.seek(0)
+    if not any(head.startswith(sig) and ext in exts for sig, exts in _RECEIPT_MAGIC):
         raise HTTPException(status_code=400, detail="Only JPG, PNG, PDF allowed")
     folder = os.path.join("static", "receipts", str(order_id))
     os.makedirs(folder, exist_ok=True)
     fname = f"{uuid.uuid4().hex}{ext}"
     path = os.path.join(folder, fname)
-    with open(path, "wb") as f:
-        f.write(upload.file.read())
+    # stream to disk in chunks so a large upload never sits in memory whole
+    size = 0
+    try:
+        async with aiofiles.open(path, "wb") as f:
+            while chunk := await upload.read(RECEIPT_CHUNK):
+                size += len(chunk)
+                if size > RECEIPT_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="Receipt file is too large (max 10 MB)")
+                await f.write(chunk)
+    except Exception:
+        # open() itself may have failed; don't mask that error
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        raise
     return f"/static/receipts/{order_id}/{fname}"
 
-def _audit(db, oid: ObjectId, actor: str, action: str, meta: Optional[dict] = None):
-    db.Orders.update_one(
-        {"_id": oid},
-        {
-            "$push": {
-                "timeline": {"ts": _now(), "actor": actor, "action": action, "meta": meta or {}}
-            },
-            "$set": {"updated_at": _now()},
-        },
-    )
+def _audit_entry(actor: str, action: str, meta: Optional[dict] = None, ts: Optional[datetime] = None) -> dict:
+    # timeline entry to $push in the same update as the change it records
+    return {"ts": ts or _now(), "actor": actor, "action": action, "meta": meta or {}}
+
+def _timeline_push(entry: dict) -> dict:
+    # $push spec that appends one entry and keeps only the newest TIMELINE_MAX
+    return {"timeline": {"$each": [entry], "$slice": -TIMELINE_MAX}}
 
 def _short_id(s: Optional[str], n: int = 6) -> str:
     if not s:
@@ -115,7 +205,7 @@ def _short_id(s: Optional[str], n: int = 6) -> str:
     s = str(s)
     return f"{s[:n]}…{s[-n:]}" if len(s) > 2 * n else s
 
-def _lookup_buyer_display(db, buyer_id: Optional[str]) -> Tuple[str, Optional[str], Optional[str]]:
+async def _lookup_buyer_display(db, buyer_id: Optional[str]) -> Tuple[str, Optional[str], Optional[str]]:
     if not buyer_id:
         return "—", None, None
     try:
@@ -124,53 +214,150 @@ def _lookup_buyer_display(db, buyer_id: Optional[str]) -> Tuple[str, Optional[st
         boid = None
 
     prof = (
-        db.user_profiles.find_one({"user_id": buyer_id})
-        or (boid and db.user_profiles.find_one({"user_id": str(boid)}))
-        or (boid and db.user_profiles.find_one({"_id": boid}))
+        await db.user_profiles.find_one({"user_id": buyer_id}, BUYER_CONTACT_FIELDS)
+        or (boid and await db.user_profiles.find_one({"user_id": str(boid)}, BUYER_CONTACT_FIELDS))
+        or (boid and await db.user_profiles.find_one({"_id": boid}, BUYER_CONTACT_FIELDS))
         or {}
     )
     name = prof.get("full_name") or prof.get("name")
     phone = prof.get("phone")
     email = prof.get("email")
     if not name and boid:
-        u = db.users.find_one({"_id": boid}) or {}
+        u = await db.users.find_one({"_id": boid}, {"full_name": 1, "name": 1, "username": 1}) or {}
         name = u.get("full_name") or u.get("name") or u.get("username")
     return (name or _short_id(buyer_id), phone, email)
 
+async def _lookup_buyer_names(db, buyer_ids) -> Dict[str, str]:
+    """
+    Batch form of _lookup_buyer_display (name only): one user_profiles query
+    and at most one users query for many buyer_ids. Returns {str(buyer_id): name}.
+    """
+    bids = {str(b) for b in buyer_ids if b}
+    if not bids:
+        return {}
+    oids: Dict[ObjectId, str] = {}
+    for b in bids:
+        try:
+            oids[_to_oid(b)] = b
+        except Exception:
+            pass
+
+    by_user_id: Dict[str, str] = {}
+    by_profile_id: Dict[str, str] = {}
+    async for p in db.user_profiles.find(
+        {"$or": [{"user_id": {"$in": list(bids)}}, {"_id": {"$in": list(oids)}}]},
+        {"user_id": 1, "full_name": 1, "name": 1},
+    ):
+        pname = p.get("full_name") or p.get("name")
+        if not pname:
+            continue
+        if p.get("user_id") is not None:
+            by_user_id.setdefault(str(p["user_id"]), pname)
+        if p["_id"] in oids:
+            by_profile_id.setdefault(oids[p["_id"]], pname)
+
+    names = {b: by_user_id.get(b) or by_profile_id.get(b) for b in bids}
+    missing = [oid for oid, b in oids.items() if not names[b]]
+    if missing:
+        async for u in db.users.find({"_id": {"$in": missing}}, {"full_name": 1, "name": 1, "username": 1}):
+            names[oids[u["_id"]]] = u.get("full_name") or u.get("name") or u.get("username")
+
+    return {b: n or _short_id(b) for b, n in names.items()}
+
+def _remember_pharmacy_name(seller_id: str, name: str) -> str:
+    _pharmacy_names[seller_id] = (time.monotonic() + PHARMACY_NAME_TTL, name)
+    _pharmacy_names.move_to_end(seller_id)
+    if len(_pharmacy_names) > PHARMACY_NAME_CACHE_SIZE:
+        _pharmacy_names.popitem(last=False)
+    return name
+
+def forget_pharmacy_name(seller_id) -> None:
+    """Drop a cached name once the seller edits their pharmacy profile."""
+    _pharmacy_names.pop(str(seller_id), None)
+
 # ---- pharmacy name resolver (original intent, but corrected) ----
-def _lookup_pharmacy_name(db, seller_id: str | None) -> str:
+async def _lookup_pharmacy_name(db, seller_id: str | None) -> str:
     """
     Resolve pharmacy name from pharmacy_profiles.user_id (seller_id).
     Tries string and ObjectId. Logs steps.
     """
     if not seller_id:
-        logger.info("[pharmacy_name] No seller_id → Unknown Pharmacy")
+        logger.debug("[pharmacy_name] No seller_id → Unknown Pharmacy")
         return "Unknown Pharmacy"
 
     sid_str = str(seller_id)
-    logger.info(f"[pharmacy_name] Looking for seller_id={sid_str!r}")
+    cached = _pharmacy_names.get(sid_str)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    logger.debug("[pharmacy_name] Looking for seller_id=%r", sid_str)
+
+    # user_id may be stored as a string or an ObjectId; ask for both at once
+    keys: List[Any] = [sid_str]
+    try:
+        keys.append(ObjectId(sid_str))
+    except Exception:
+        pass
+    async for doc in db.pharmacy_profiles.find({"user_id": {"$in": keys}}, {"pharmacy_name": 1, "name": 1}):
+        name = doc.get("pharmacy_name") or doc.get("name")
+        if name:
+            logger.debug("[pharmacy_name] ✓ by user_id → %r", name)
+            return _remember_pharmacy_name(sid_str, name)
+
+    # misses are cached too; forget_pharmacy_name clears them on profile save
+    logger.debug("[pharmacy_name] ✗ not found for seller_id=%r", sid_str)
+    return _remember_pharmacy_name(sid_str, "Unknown Pharmacy")
+
+async def _lookup_pharmacy_names(db, seller_ids) -> Dict[str, str]:
+    """
+    Batch form of _lookup_pharmacy_name: one $in query (string and ObjectId
+    user_id forms) for many seller_ids. Returns {str(seller_id): name}.
+    Shares the TTL cache with the single lookup; only misses hit Mongo.
+    """
+    names: Dict[str, str] = {}
+    now_m = time.monotonic()
+    sids = set()
+    for s in seller_ids:
+        if not s:
+            continue
+        cached = _pharmacy_names.get(str(s))
+        if cached and cached[0] > now_m:
+            names[str(s)] = cached[1]
+        else:
+            sids.add(str(s))
+    if not sids:
+        return names
+    keys: List[Any] = list(sids)
+    for s in sids:
+        try:
+            keys.append(ObjectId(s))
+        except Exception:
+            pass
 
-    # user_id stored as string
-    doc = db.pharmacy_profiles.find_one({"user_id": sid_str})
-    if doc and (doc.get("pharmacy_name") or doc.get("name")):
+    async for doc in db.pharmacy_profiles.find({"user_id": {"$in": keys}}, {"user_id": 1, "pharmacy_name": 1, "name": 1}):
         name = doc.get("pharmacy_name") or doc.get("name")
-        logger.info(f"[pharmacy_name] ✓ by user_id(str) → {name!r}")
-        return name
+        uid = str(doc["user_id"])
+        if name and uid not in names:
+            names[uid] = _remember_pharmacy_name(uid, name)
+    return names
+
+# background-task targets: awaited here so a failed backfill is logged
+async def _backfill_pharmacy_names(ops: List[UpdateOne]) -> None:
+    try:
+        await get_async_database().Orders.bulk_write(ops, ordered=False)
+    except Exception:
+        logger.exception("[pharmacy_name] backfill of %d orders failed", len(ops))
 
-    # user_id stored as ObjectId
+async def _set_pharmacy_name(oid: ObjectId, name: str, now: datetime) -> None:
     try:
-        oid = ObjectId(sid_str)
+        await get_async_database().Orders.update_one({"_id": oid}, {"$set": {"pharmacy_name": name, "updated_at": now}})
     except Exception:
-        oid = None
-    if oid:
-        doc = db.pharmacy_profiles.find_one({"user_id": oid})
-        if doc and (doc.get("pharmacy_name") or doc.get("name")):
-            name = doc.get("pharmacy_name") or doc.get("name")
-            logger.info(f"[pharmacy_name] ✓ by user_id(ObjectId) → {name!r}")
-            return name
+        logger.exception("[pharmacy_name] backfill failed order=%s", oid)
 
-    logger.info(f"[pharmacy_name] ✗ not found for seller_id={sid_str!r}")
-    return "Unknown Pharmacy"
+def _order_total(o: dict, items: List[dict]) -> float:
+    total = o.get("total_amount")
+    if total is None:
+        total = sum(float(i.get("price") or 0) * int(i.get("quantity") or 0) for i in items)
+    return total
 
 def _extract_shipping(o: dict) -> Dict[str, Optional[str]]:
     ship = o.get("shipping") or o.get("shipping_address") or o.get("delivery_address") or {}
@@ -216,10 +403,11 @@ from reportlab.lib import colors
 from reportlab.lib.units import mm
 from reportlab.pdfbase import pdfmetrics
 
-def _generate_seller_receipt(db, order: dict, out_dir: str = "static/seller_receipts") -> str:
+def _generate_seller_receipt(order: dict, buyer_name: str, out_dir: str = "static/seller_receipts") -> str:
     """
     Create a nicer PDF voucher (seller-issued receipt) for the order.
     Returns a web path like: /static/seller_receipts/<order_id>/receipt.pdf
+    Blocking (reportlab + disk); call it through run_in_threadpool.
     """
     import os
     os.makedirs(out_dir, exist_ok=True)
@@ -230,7 +418,6 @@ def _generate_seller_receipt(db, order: dict, out_dir: str = "static/seller_rece
     url_path = f"/{subdir.replace(os.sep, '/')}/receipt.pdf"
 
     # ---- data ----
-    buyer_name, _, _ = _lookup_buyer_display(db, order.get("buyer_id"))
     ship = _extract_shipping(order) or {}
     addr = ship.get("address") or ship.get("address_line") or ship.get("line1") or "-"
     city = ship.get("city") or "-"
@@ -383,17 +570,18 @@ def _generate_seller_receipt(db, order: dict, out_dir: str = "static/seller_rece
     return url_path
 
 
-def notify_buyer_with_receipt(db, order: dict, receipt_url: str) -> None:
+async def notify_buyer_with_receipt(db, order: dict, receipt_url: str) -> None:
     """
     Minimal 'notification': log + add timeline + stamp sent_at.
     Replace this with email/SMS/FCM/etc. when ready.
     """
     logger.info("[receipt_notify] order=%s -> %s", order.get("_id"), receipt_url)
-    db.Orders.update_one(
+    now = _now()
+    await db.Orders.update_one(
         {"_id": order["_id"]},
         {
-            "$set": {"payment.seller_receipt_sent_at": _now(), "updated_at": _now()},
-            "$push": {"timeline": {"ts": _now(), "actor": "system", "action": "seller_receipt_sent", "meta": {"url": receipt_url}}},
+            "$set": {"payment.seller_receipt_sent_at": now, "updated_at": now},
+            "$push": _timeline_push(_audit_entry("system", "seller_receipt_sent", {"url": receipt_url}, now)),
         },
     )
 
@@ -416,29 +604,32 @@ def _to_hex(val) -> str:
 
 # ============== STOCK HELPERS (Medicine collection) ==============
 
-def _reserve_item(db, mid: ObjectId, qty: int) -> bool:
-    # available = stock - reserved  >= qty
-    q = {
-        "_id": mid,
-        "$expr": {"$gte": [{"$subtract": ["$stock", {"$ifNull": ["$reserved", 0]}]}, qty]}
-    }
-    upd = {"$inc": {"reserved": qty}}
-    return db.Medicine.update_one(q, upd).modified_count == 1
+async def _reserve_item(db, mid: ObjectId, qty: int) -> bool:
+    # available (= stock - reserved, maintained on every write) >= qty
+    q = {"_id": mid, "available": {"$gte": qty}}
+    upd = {"$inc": {"reserved": qty, "available": -qty}}
+    return (await db.Medicine.update_one(q, upd)).modified_count == 1
 
-def _release_item(db, mid: ObjectId, qty: int) -> bool:
+async def _release_item(db, mid: ObjectId, qty: int) -> bool:
     q = {"_id": mid, "$expr": {"$gte": [{"$ifNull": ["$reserved", 0]}, qty]}}
-    upd = {"$inc": {"reserved": -qty}}
-    return db.Medicine.update_one(q, upd).modified_count == 1
+    upd = {"$inc": {"reserved": -qty, "available": qty}}
+    return (await db.Medicine.update_one(q, upd)).modified_count == 1
 
-def _commit_item(db, mid: ObjectId, qty: int) -> bool:
-    # move from reserved → stock (decrement both)
+async def _commit_item(db, mid: ObjectId, qty: int) -> bool:
+    # move from reserved → stock (decrement both; available is unchanged)
     q = {"_id": mid, "$expr": {"$gte": [{"$ifNull": ["$reserved", 0]}, qty]}}
     upd = {"$inc": {"stock": -qty, "reserved": -qty}}
-    return db.Medicine.update_one(q, upd).modified_count == 1
+    return (await db.Medicine.update_one(q, upd)).modified_count == 1
+
+async def _uncommit_item(db, mid: ObjectId, qty: int) -> bool:
+    # undo _commit_item: put the units back into stock, still reserved
+    upd = {"$inc": {"stock": qty, "reserved": qty}}
+    return (await db.Medicine.update_one({"_id": mid}, upd)).modified_count == 1
 
 
-def create_notification(db, *, user_id: str, role: str, type_: str,
-                        title: str, message: str, order_id=None, meta: dict | None = None):
+async def create_notification(db, *, user_id: str, role: str, type_: str,
+                        title: str, message: str, order_id=None, meta: dict | None = None,
+                        now: datetime | None = None):
     doc = {
         "user_id": str(user_id),
         "role": role,
@@ -448,15 +639,68 @@ def create_notification(db, *, user_id: str, role: str, type_: str,
         "order_id": str(order_id) if order_id else None,
         "meta": meta or {},
         "is_read": False,
-        "created_at": _now(),
+        "created_at": now or _now(),
         "read_at": None,
     }
-    db.Notifications.insert_one(doc)
+    await db.Notifications.insert_one(doc)
+    # keep the unread badge counter in step (read by /notifications/unread_count)
+    await db.NotifCounters.update_one({"user_id": doc["user_id"]}, {"$inc": {"unread": 1}}, upsert=True)
     return doc
+def _cart_merge_pipeline(line: dict, pharmacy_name: str, entry: dict, now: datetime) -> list:
+    """
+    Update pipeline for add_to_cart: bump the matching item (or append `line`),
+    recompute total_amount on the server and seed the cart fields on upsert,
+    so the merge is a single atomic write instead of read-modify-write.
+    """
+    mid = str(line["medicine_id"])
+    qty, price = line["quantity"], line["price"]
+    items = {"$ifNull": ["$items", []]}
+    new_qty = {"$add": [{"$ifNull": ["$$it.quantity", 0]}, qty]}
+    bumped = {
+        "quantity": new_qty,
+        "price": price,
+        "buying_price": line["buying_price"],
+        "total": {"$multiply": [new_qty, price]},
+    }
+    if "reserved_qty" in line:
+        # keep reserved == quantity for pending
+        bumped["reserved_qty"] = new_qty
+
+    return [
+        {"$set": {
+            "items": {"$cond": [
+                {"$in": [mid, {"$map": {"input": items, "as": "it", "in": {"$toString": "$$it.medicine_id"}}}]},
+                {"$map": {"input": items, "as": "it", "in": {"$cond": [
+                    {"$eq": [{"$toString": "$$it.medicine_id"}, mid]},
+                    {"$mergeObjects": ["$$it", bumped]},
+                    "$$it",
+                ]}}},
+                {"$concatArrays": [items, [{"$literal": line}]]},
+            ]},
+        }},
+        {"$set": {
+            "total_amount": {"$sum": {"$map": {"input": "$items", "as": "it", "in": {
+                "$multiply": [{"$ifNull": ["$$it.quantity", 0]}, {"$ifNull": ["$$it.price", 0]}],
+            }}}},
+            # readers fall back to formatting total_amount
+            "formatted_total": "$$REMOVE",
+            "pharmacy_name": {"$literal": pharmacy_name},
+            "order_status": {"$ifNull": ["$order_status", "cart"]},
+            "status": {"$ifNull": ["$status", "cart"]},
+            "payment_status": {"$ifNull": ["$payment_status", "unpaid"]},
+            "payment": {"$ifNull": ["$payment", {"$literal": {
+                "payment_id": None, "receipt_path": None, "rejected_reason": None, "uploaded_at": None,
+            }}]},
+            "created_at": {"$ifNull": ["$created_at", now]},
+            "updated_at": now,
+            "timeline": {"$slice": [
+                {"$concatArrays": [{"$ifNull": ["$timeline", []]}, [{"$literal": entry}]]},
+                -TIMELINE_MAX,
+            ]},
+        }},
+    ]
+
 # ======================== BUYER FLOWS ========================
-class AddToCartRequest(BaseModel):
-    medicine_id: str
-    quantity: int
 @router.post("/buyer/add_to_cart")
 async def add_to_cart(
     medicine_id: str = Form(...),
@@ -464,165 +708,109 @@ async def add_to_cart(
     current_user: dict = Depends(require_role("buyer")),
 ):
     buyer_id = current_user["id"]
+    # Form() has already coerced both fields; only the range is checked here
     if quantity < 1:
         quantity = 1
 
-    try:
-        payload = AddToCartRequest(medicine_id=medicine_id, quantity=quantity)
-    except ValidationError as e:
-        raise HTTPException(status_code=422, detail=str(e))
-
-    db = get_database()
+    db = get_async_database()
+    now = _now()
 
     # Load medicine
     try:
-        med_oid = _to_oid(payload.medicine_id)
+        med_oid = _to_oid(medicine_id)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid medicine ID")
 
-    med = db.Medicine.find_one({"_id": med_oid})
+    med = await db.Medicine.find_one(
+        {"_id": med_oid},
+        {"name": 1, "selling_price": 1, "buying_price": 1, "available": 1, "seller_id": 1},
+    )
     if not med:
         raise HTTPException(status_code=404, detail="Medicine not found")
 
     price_sell = float(med.get("selling_price", 0) or 0)
     price_buy  = float(med.get("buying_price", 0) or 0)
-    available  = int(med.get("stock", 0)) - int(med.get("reserved", 0) or 0)
+    available  = int(med.get("available", 0) or 0)
 
     if available <= 0:
         raise HTTPException(status_code=409, detail="Out of stock")
 
     seller_id        = med.get("seller_id")
     pharmacy_id_str  = str(seller_id) if seller_id else None
-    pharmacy_name    = _lookup_pharmacy_name(db, pharmacy_id_str)
-    logger.info(f"[cart] med={med.get('name')} seller_id={pharmacy_id_str} resolved_name={pharmacy_name}")
+    pharmacy_name    = await _lookup_pharmacy_name(db, pharmacy_id_str)
+    logger.debug("[cart] med=%s seller_id=%s resolved_name=%s", med.get("name"), pharmacy_id_str, pharmacy_name)
 
-    # Find open order (cart or pending, unpaid/rejected)
-    existing = db.Orders.find_one({
+    # Find open order (cart or pending, unpaid/rejected); only its status is
+    # needed here, the line merge itself happens server-side below
+    open_q = {
         "buyer_id": buyer_id,
         "pharmacy_id": pharmacy_id_str,
         "order_status": {"$in": ["cart", "pending"]},
         "payment_status": {"$in": ["unpaid", "rejected"]},
-    })
+    }
+    existing = await db.Orders.find_one(open_q, {"order_status": 1})
 
-    add_qty = int(payload.quantity)
+    add_qty = quantity
     line_delta_total = add_qty * price_sell
+    is_pending = bool(existing) and existing.get("order_status") == "pending"
+
+    if is_pending:
+        # pending orders hold stock: reserve the additional quantity first
+        if not await _reserve_item(db, med_oid, add_qty):
+            raise HTTPException(status_code=409, detail="out_of_stock")
+    elif existing and available < add_qty:
+        # in cart: basic guard to avoid obvious oversell
+        raise HTTPException(status_code=409, detail="Out of stock")
+
+    line = {
+        "medicine_id": med["_id"],
+        "medicine_name": med.get("name", "Unknown"),
+        "quantity": add_qty,
+        "price": price_sell,
+        "buying_price": price_buy,
+        "total": line_delta_total,
+    }
+    if is_pending:
+        line["reserved_qty"] = add_qty
 
     if existing:
-        items = existing.get("items") or []
-        idx = next((i for i, it in enumerate(items)
-                    if str(it.get("medicine_id")) == str(med["_id"])), None)
-
-        is_pending = (existing.get("order_status") == "pending")
-
-        if idx is not None:
-            # If pending, reserve the additional quantity first
-            if is_pending:
-                if not _reserve_item(db, med_oid, add_qty):
-                    raise HTTPException(status_code=409, detail="out_of_stock")
-                # grow reserved on that line
-                items[idx]["reserved_qty"] = int(items[idx].get("reserved_qty", items[idx].get("quantity", 0))) + add_qty
-            else:
-                # in cart: basic guard to avoid obvious oversell
-                if available < add_qty:
-                    raise HTTPException(status_code=409, detail="Out of stock")
-
-            new_qty = int(items[idx].get("quantity", 0)) + add_qty
-            items[idx]["quantity"]      = new_qty
-            items[idx]["price"]         = price_sell
-            items[idx]["buying_price"]  = price_buy
-            items[idx]["total"]         = new_qty * price_sell
-
-            if is_pending:
-                # keep reserved == quantity for pending
-                items[idx]["reserved_qty"] = new_qty
-        else:
-            # New line
-            if is_pending:
-                if not _reserve_item(db, med_oid, add_qty):
-                    raise HTTPException(status_code=409, detail="out_of_stock")
-                items.append({
-                    "medicine_id": med["_id"],
-                    "medicine_name": med.get("name", "Unknown"),
-                    "quantity": add_qty,
-                    "reserved_qty": add_qty,
-                    "price": price_sell,
-                    "buying_price": price_buy,
-                    "total": line_delta_total,
-                })
-            else:
-                if available < add_qty:
-                    raise HTTPException(status_code=409, detail="Out of stock")
-                items.append({
-                    "medicine_id": med["_id"],
-                    "medicine_name": med.get("name", "Unknown"),
-                    "quantity": add_qty,
-                    "price": price_sell,
-                    "buying_price": price_buy,
-                    "total": line_delta_total,
-                })
-
-        total_amount   = sum(int(it.get("quantity", 0)) * float(it.get("price", 0) or 0.0) for it in items)
-        formatted_total = format_currency(total_amount)
-
-        db.Orders.update_one(
-            {"_id": existing["_id"]},
-            {
-                "$set": {
-                    "items": items,
-                    "total_amount": total_amount,
-                    "formatted_total": formatted_total,
-                    "pharmacy_name": pharmacy_name,
-                    "updated_at": _now(),
-                },
-                "$push": {
-                    "timeline": {
-                        "ts": _now(),
-                        "actor": "buyer",
-                        "action": "add_to_cart",
-                        "meta": {"medicine_id": str(med["_id"]), "quantity_added": add_qty, "line_total_added": line_delta_total},
-                    }
-                },
-            },
-        )
-        return JSONResponse(status_code=200, content={
-            "message": "Updated existing order.", "order_id": str(existing["_id"]), "merged": True
-        })
+        q = {**open_q, "_id": existing["_id"], "order_status": existing["order_status"]}
+        entry = {"ts": now, "actor": "buyer", "action": "add_to_cart",
+                 "meta": {"medicine_id": str(med["_id"]), "quantity_added": add_qty, "line_total_added": line_delta_total}}
+    else:
+        # New order (cart state, no reservation yet), created by the upsert
+        q = open_q
+        entry = {"ts": now, "actor": "buyer", "action": "create_cart",
+                 "meta": {"medicine_id": str(med["_id"]), "quantity": add_qty, "line_total": line_delta_total}}
 
-    # New order (cart state, no reservation yet)
-    order_doc = {
-        "buyer_id": buyer_id,
-        "pharmacy_id": pharmacy_id_str,
-        "pharmacy_name": pharmacy_name,
-        "items": [{
-            "medicine_id": med["_id"],
-            "medicine_name": med.get("name", "Unknown"),
-            "quantity": add_qty,
-            "price": price_sell,
-            "buying_price": price_buy,
-            "total": line_delta_total,
-        }],
-        "total_amount": line_delta_total,
-        "formatted_total": format_currency(line_delta_total),
-        "order_status": "cart",
-        "status": "cart",
-        "payment_status": "unpaid",
-        "payment": {"payment_id": None, "receipt_path": None, "rejected_reason": None, "uploaded_at": None},
-        "created_at": _now(),
-        "updated_at": _now(),
-        "timeline": [{
-            "ts": _now(), "actor": "buyer", "action": "create_cart",
-            "meta": {"medicine_id": str(med["_id"]), "quantity": add_qty, "line_total": line_delta_total},
-        }],
-    }
     try:
-        res = db.Orders.insert_one(order_doc)
-        logger.info(f"[cart] Created order={res.inserted_id} for seller_id={pharmacy_id_str} name={pharmacy_name}")
+        o = await db.Orders.find_one_and_update(
+            q,
+            _cart_merge_pipeline(line, pharmacy_name, entry, now),
+            projection={"_id": 1},
+            upsert=existing is None,
+            return_document=ReturnDocument.AFTER,
+        )
     except Exception:
-        logger.exception("Failed to create order")
+        if is_pending:
+            await _release_item(db, med_oid, add_qty)
+        logger.exception("Failed to update cart")
         raise HTTPException(status_code=500, detail="Failed to create order")
 
+    if o is None:
+        # the order was submitted/cancelled between the lookup and the update
+        if is_pending:
+            await _release_item(db, med_oid, add_qty)
+        raise HTTPException(status_code=409, detail="Order changed, please try again")
+
+    if existing:
+        return JSONResponse(status_code=200, content={
+            "message": "Updated existing order.", "order_id": str(o["_id"]), "merged": True
+        })
+
+    logger.info("[cart] Created order=%s for seller_id=%s name=%s", o["_id"], pharmacy_id_str, pharmacy_name)
     return JSONResponse(status_code=200, content={
-        "message": "Created a new order.", "order_id": str(res.inserted_id), "merged": False
+        "message": "Created a new order.", "order_id": str(o["_id"]), "merged": False
     })
 
 from pydantic import BaseModel, Field
@@ -631,27 +819,36 @@ class UpdateItemReq(BaseModel):
     delta: int = Field(..., description="Use +1 to increase or -1 to decrease")
     
 @router.post("/buyer/orders/{order_id}/update_item")
-def update_item(
+async def update_item(
     order_id: str,
     payload: UpdateItemReq,
     current_user: dict = Depends(require_role("buyer")),
 ):
-    db = get_database()
+    db = get_async_database()
+    now = _now()
     oid = _to_oid(order_id)
 
-    o = db.Orders.find_one({
+    editable = {
         "_id": oid,
         "buyer_id": current_user["id"],
         "order_status": {"$in": ["cart", "pending"]},
         "payment_status": {"$in": ["unpaid", "rejected"]},
-    })
+    }
+    o = await db.Orders.find_one(editable, NO_TIMELINE)
     if not o:
         return JSONResponse(status_code=400, content={"detail": "not_editable"})
 
     want  = _normalize_mid(payload.medicine_id)
     items = list(o.get("items") or [])
 
-    idx = next((i for i, it in enumerate(items) if _extract_item_mid(it) == want), None)
+    # items store medicine_id as an ObjectId: compare those directly and only
+    # normalise every line's id (regex + str per item) for legacy shapes
+    idx = None
+    if ObjectId.is_valid(want):
+        want_oid = ObjectId(want)
+        idx = next((i for i, it in enumerate(items) if it.get("medicine_id") == want_oid), None)
+    if idx is None:
+        idx = next((i for i, it in enumerate(items) if _extract_item_mid(it) == want), None)
     if idx is None:
         idx = next((i for i, it in enumerate(items) if str(it.get("medicine_name")) == str(payload.medicine_id)), None)
     if idx is None:
@@ -662,6 +859,7 @@ def update_item(
     new_qty    = int(it.get("quantity", 0)) + delta
     is_pending = (o.get("order_status") == "pending")
 
+    mid = None
     # try to reserve/release first (when pending)
     if is_pending and delta != 0:
         try:
@@ -670,39 +868,63 @@ def update_item(
             return JSONResponse(status_code=400, content={"detail": "bad_medicine_id"})
 
         if delta > 0:
-            if not _reserve_item(db, mid, delta):
+            if not await _reserve_item(db, mid, delta):
                 return JSONResponse(status_code=409, content={"detail": "out_of_stock"})
             it["reserved_qty"] = int(it.get("reserved_qty", it.get("quantity", 0))) + delta
         else:
             rel = abs(delta)
-            _release_item(db, mid, rel)
+            await _release_item(db, mid, rel)
             it["reserved_qty"] = max(0, int(it.get("reserved_qty", it.get("quantity", 0))) - rel)
 
-    removed = False
-    if new_qty <= 0:
-        # if removing the row while pending, release any remaining reserved
-        if is_pending:
-            try:
-                mid = _to_oid(_extract_item_mid(it))
-                rq  = int(it.get("reserved_qty", it.get("quantity", 0)) or 0)
-                if rq > 0: _release_item(db, mid, rq)
-            except Exception:
-                pass
-        items.pop(idx)
-        removed = True
-        line_total = 0.0
-    else:
-        it["quantity"] = new_qty
-        price          = float(it.get("price", 0) or 0.0)
-        it["total"]    = new_qty * price
+    if new_qty > 0:
+        # quantity change: adjust just this line in place; $inc keeps two
+        # quick taps from overwriting each other's write
+        key, val = ("medicine_id", it["medicine_id"]) if "medicine_id" in it else ("medicine_name", it.get("medicine_name"))
+        price = float(it.get("price", 0) or 0.0)
+        inc = {"items.$[ln].quantity": delta, "items.$[ln].total": delta * price, "total_amount": delta * price}
         if is_pending:
-            # keep reserved == quantity to stay in sync
-            it["reserved_qty"] = new_qty
-        items[idx] = it
-        line_total = it["total"]
+            inc["items.$[ln].reserved_qty"] = delta
+        after = await db.Orders.find_one_and_update(
+            {**editable, "items": {"$elemMatch": {key: val, "quantity": {"$gte": 1 - delta}}}},
+            {"$inc": inc, "$set": {"updated_at": now}, "$unset": {"formatted_total": ""}},
+            array_filters=[{f"ln.{key}": val}],
+            projection={"total_amount": 1, "items": {"$elemMatch": {key: val}}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if after is None:
+            # the line or the order moved under us; hand the stock change back
+            if mid is not None:
+                try:
+                    if delta > 0: await _release_item(db, mid, delta)
+                    else: await _reserve_item(db, mid, -delta)
+                except Exception:
+                    pass
+            return JSONResponse(status_code=409, content={"detail": "order_changed"})
+        line = (after.get("items") or [{}])[0]
+        qty = int(line.get("quantity", 0) or 0)
+        total_amount = float(after.get("total_amount") or 0.0)
+        return {
+            "deleted": False,
+            "removed": False,
+            "quantity": qty,
+            "line_total": qty * float(line.get("price", 0) or 0.0),
+            "order_total": total_amount,
+            "formatted_order_total": format_currency(total_amount),
+        }
+
+    # the line goes away: rewrite the remaining items
+    if is_pending:
+        # release any remaining reserved
+        try:
+            mid = _to_oid(_extract_item_mid(it))
+            rq  = int(it.get("reserved_qty", it.get("quantity", 0)) or 0)
+            if rq > 0: await _release_item(db, mid, rq)
+        except Exception:
+            pass
+    items.pop(idx)
 
     if len(items) == 0:
-        db.Orders.delete_one({"_id": o["_id"]})
+        await db.Orders.delete_one({"_id": o["_id"]})
         return {
             "deleted": True,
             "removed": True,
@@ -715,39 +937,39 @@ def update_item(
     total_amount    = sum(int(x.get("quantity", 0)) * float(x.get("price", 0) or 0.0) for x in items)
     formatted_total = format_currency(total_amount)
 
-    db.Orders.update_one(
+    await db.Orders.update_one(
         {"_id": o["_id"]},
         {"$set": {
             "items": items,
             "total_amount": total_amount,
             "formatted_total": formatted_total,
-            "updated_at": _now(),
+            "updated_at": now,
         }}
     )
 
     return {
         "deleted": False,
-        "removed": removed,
-        "quantity": 0 if removed else new_qty,
-        "line_total": line_total,
+        "removed": True,
+        "quantity": 0,
+        "line_total": 0.0,
         "order_total": total_amount,
         "formatted_order_total": formatted_total,
     }
 
 @router.post("/buyer/orders/{order_id}/cancel")
-def buyer_cancel_order(
+async def buyer_cancel_order(
     order_id: str,
     current_user: dict = Depends(require_role("buyer")),
 ):
-    db = get_database()
+    db = get_async_database()
     oid = _to_oid(order_id)
 
-    o = db.Orders.find_one({
+    o = await db.Orders.find_one({
         "_id": oid,
         "buyer_id": current_user["id"],
         "order_status": {"$in": ["cart", "pending"]},
         "payment_status": {"$in": ["unpaid", "rejected"]},
-    })
+    }, NO_TIMELINE)
     if not o:
         raise HTTPException(400, "Order cannot be cancelled at this stage")
 
@@ -757,20 +979,20 @@ def buyer_cancel_order(
             rq = int(it.get("reserved_qty", it.get("quantity", 0)) or 0)
             if rq > 0:
                 try:
-                    _release_item(db, _to_oid(_extract_item_mid(it)), rq)
+                    await _release_item(db, _to_oid(_extract_item_mid(it)), rq)
                 except Exception:
                     pass
 
-    db.Orders.delete_one({"_id": o["_id"]})
-    _audit(db, oid, "buyer", "cancelled_order", {})
+    await db.Orders.delete_one({"_id": o["_id"]})
 
     return RedirectResponse("/buyer/orders", status_code=303)
 
 
 @router.get("/buyer/orders", response_class=HTMLResponse)
-def buyer_orders(request: Request, current_user: dict = Depends(require_role("buyer"))):
-    db = get_database()
-    tz = _user_tz(request, db, current_user)
+async def buyer_orders(request: Request, background_tasks: BackgroundTasks, current_user: dict = Depends(require_role("buyer"))):
+    db = get_async_database()
+    now = _now()
+    tz = await _user_tz(request, db, current_user)
     buyer_id = current_user["id"]
     filt = {
         "buyer_id": current_user["id"],
@@ -787,9 +1009,13 @@ def buyer_orders(request: Request, current_user: dict = Depends(require_role("bu
     query: Dict[str, Any] = {"buyer_id": buyer_id}
     if status in ["cart", "pending", "confirmed", "delivered"]:
         query["order_status"] = status
-    if q:
-        rx = {"$regex": re.escape(q), "$options": "i"}
+    if q.startswith("^"):
+        # explicit prefix search keeps the case-insensitive regex match
+        rx = {"$regex": "^" + re.escape(q[1:]), "$options": "i"}
         query["$or"] = [{"pharmacy_name": rx}, {"items.medicine_name": rx}]
+    elif q:
+        # word search through the buyer_id-prefixed text index
+        query["$text"] = {"$search": q}
 
     sort_map = {
         "created_desc": [("created_at", -1)],
@@ -799,54 +1025,86 @@ def buyer_orders(request: Request, current_user: dict = Depends(require_role("bu
     }
     sort_spec = sort_map.get(sort_key, [("created_at", -1)])
 
-    orders = list(db.Orders.find(query).sort(sort_spec))
+    projection = BUYER_LIST_FIELDS
+    if "$text" in query:
+        projection = {**BUYER_LIST_FIELDS, "score": {"$meta": "textScore"}}
+        if "sort" not in request.query_params:
+            # no explicit sort chosen: best matches first
+            sort_spec = [("score", {"$meta": "textScore"}), ("created_at", -1)]
+
+    hint = BUYER_STATUS_HINTS.get(sort_key) if "order_status" in query and "$text" not in query else None
+    page, size = _page_args(request)
+    try:
+        cur = db.Orders.find(query, projection).sort(sort_spec)
+        orders, has_next = await _fetch_page(cur.hint(hint) if hint else cur, page, size)
+    except OperationFailure:
+        if not hint:
+            raise
+        # hinted index missing or still building (ensure_indexes runs in the
+        # background); let the planner choose instead
+        logger.warning("[buyer_list] hint %s unusable, retrying unhinted", hint)
+        cur = db.Orders.find(query, projection).sort(sort_spec)
+        orders, has_next = await _fetch_page(cur, page, size)
+
+    # one query for every order still missing its pharmacy name
+    pharmacy_names = await _lookup_pharmacy_names(
+        db, (o.get("pharmacy_id") or o.get("seller_id") for o in orders if not o.get("pharmacy_name"))
+    )
 
     formatted_orders = []
+    backfill: List[UpdateOne] = []
     for o in orders:
-        items = [{
-            "medicine_name": it.get("medicine_name", "Unknown"),
-            "quantity": int(it.get("quantity", 0) or 0),
-            "price": float(it.get("price", 0) or 0.0),
-        } for it in (o.get("items") or [])]
+        # projected item subdocs go to the template as-is
+        items = o.get("items") or []
 
-        computed_total = sum(i["price"] * i["quantity"] for i in items)
         created_at = o.get("created_at")
 
         # resolve & backfill name if missing
-        resolved = o.get("pharmacy_name") or _lookup_pharmacy_name(db, o.get("pharmacy_id") or o.get("seller_id"))
+        sid = o.get("pharmacy_id") or o.get("seller_id")
+        resolved = o.get("pharmacy_name") or pharmacy_names.get(str(sid) if sid else "", "Unknown Pharmacy")
         if resolved and resolved != o.get("pharmacy_name"):
-            db.Orders.update_one({"_id": o["_id"]}, {"$set": {"pharmacy_name": resolved, "updated_at": _now()}})
-        logger.info(f"[buyer_list] order={o.get('_id')} pid={o.get('pharmacy_id')} name={resolved}")
+            backfill.append(UpdateOne({"_id": o["_id"]}, {"$set": {"pharmacy_name": resolved, "updated_at": now}}))
+        logger.debug("[buyer_list] order=%s pid=%s name=%s", o.get("_id"), o.get("pharmacy_id"), resolved)
+        pay = o.get("payment") or _NO_PAYMENT
 
         formatted_orders.append({
             "_id": str(o.get("_id")),
             "created_at": created_at,
-            "created_at_str": _fmt_dt_local(created_at, tz),
             "order_status": (o.get("order_status") or o.get("status") or "cart").lower(),
             "payment_status": (o.get("payment_status") or "unpaid").lower(),
             "items": items,
             "pharmacy_name": resolved or "Unknown Pharmacy",
-            "formatted_total": o.get("formatted_total") or format_currency(computed_total),
+            # same output as format_currency, inlined for the per-row loop;
+            # total_amount is kept current on every write, items are only
+            # summed for legacy rows without it
+            "formatted_total": o.get("formatted_total") or f'{_order_total(o, items):.2f}Ks',
             "payment": {
-                "payment_id": (o.get("payment") or {}).get("payment_id"),
-                "receipt_path": (o.get("payment") or {}).get("receipt_path"),
-                "rejected_reason": (o.get("payment") or {}).get("rejected_reason"),
+                "payment_id": pay.get("payment_id"),
+                "receipt_path": pay.get("receipt_path"),
+                "rejected_reason": pay.get("rejected_reason"),
             },
         })
 
+    if backfill:
+        # one round-trip for every name resolved on this page, after the response
+        background_tasks.add_task(_backfill_pharmacy_names, backfill)
+
     return templates.TemplateResponse(
         "buyer/orders_list.html",
-        {"request": request, "orders": formatted_orders, "current_user": current_user, "sort": sort_key, "status": status or "", "q": q},
+        {"request": request, "orders": formatted_orders, "current_user": current_user, "sort": sort_key, "status": status or "", "q": q, "tz": tz,
+         "page": page, "has_next": has_next},
     )
 
 @router.get("/buyer/orders/{order_id}", response_class=HTMLResponse)
-def buyer_order_detail(
+async def buyer_order_detail(
     request: Request,
     order_id: str,
+    background_tasks: BackgroundTasks,
     current_user: dict = Depends(require_role("buyer")),
 ):
-    db = get_database()
-    tz = _user_tz(request, db, current_user)
+    db = get_async_database()
+    now = _now()
+    tz = await _user_tz(request, db, current_user)
 
     # --- Load order ---
     try:
@@ -854,39 +1112,24 @@ def buyer_order_detail(
     except Exception:
         raise HTTPException(404, "Order not found")
 
-    o = db.Orders.find_one({"_id": oid, "buyer_id": current_user["id"]})
+    o = await db.Orders.find_one({"_id": oid, "buyer_id": current_user["id"]}, NO_TIMELINE)
     if not o:
         raise HTTPException(404, "Order not found")
 
     # --- Items & totals ---
     ship = _extract_shipping(o)
-    items = []
-    for it in (o.get("items") or []):
-        q = int(it.get("quantity", 0) or 0)
-        p_sell = float(it.get("price", 0) or 0.0)
-        items.append({
-            "medicine_name": it.get("medicine_name", "Unknown"),
-            "quantity": q,
-            "price": p_sell,
-            "line_total": q * p_sell
-        })
-
-    total_amount = o.get("total_amount")
-    if total_amount is None:
-        total_amount = sum(x["line_total"] for x in items)
+    items = o.get("items") or []
+    total_amount = _order_total(o, items)
 
     # --- Resolve pharmacy display name on the order (once) ---
-    resolved_name = o.get("pharmacy_name") or _lookup_pharmacy_name(
+    resolved_name = o.get("pharmacy_name") or await _lookup_pharmacy_name(
         db, o.get("pharmacy_id") or o.get("seller_id")
     )
     if resolved_name and resolved_name != o.get("pharmacy_name"):
-        db.Orders.update_one(
-            {"_id": o["_id"]},
-            {"$set": {"pharmacy_name": resolved_name, "updated_at": _now()}}
-        )
+        background_tasks.add_task(_set_pharmacy_name, o["_id"], resolved_name, now)
 
     pid = o.get("pharmacy_id") or o.get("seller_id")
-    logger.info(
+    logger.debug(
         "[buyer_detail] order=%s pid=%s name=%s",
         o.get("_id"), pid, resolved_name
     )
@@ -896,7 +1139,7 @@ def buyer_order_detail(
     if pid:
         # Try as profile _id
         try:
-            pharmacy_profile = db.pharmacy_profiles.find_one({"_id": _to_oid(pid)})
+            pharmacy_profile = await db.pharmacy_profiles.find_one({"_id": _to_oid(pid)}, PAYMENT_PROFILE_FIELDS)
         except Exception:
             pharmacy_profile = None
 
@@ -904,40 +1147,39 @@ def buyer_order_detail(
         if not pharmacy_profile:
             # pid could be ObjectId or str; normalize to str for user_id
             pid_str = str(pid)
-            pharmacy_profile = db.pharmacy_profiles.find_one({"user_id": pid_str})
+            pharmacy_profile = await db.pharmacy_profiles.find_one({"user_id": pid_str}, PAYMENT_PROFILE_FIELDS)
 
     # Pull QR/instructions if present
     pharmacy_qr_url = (pharmacy_profile or {}).get("payment_qr_url")
     payment_instructions = (pharmacy_profile or {}).get("payment_instructions")
 
-    logger.info(
+    logger.debug(
         "[buyer_detail] qr_found=%s instr_found=%s profile_id=%s",
         bool(pharmacy_qr_url), bool(payment_instructions),
         (str(pharmacy_profile.get('_id')) if pharmacy_profile else None)
     )
 
     # --- Build template model (put QR fields INSIDE order) ---
+    pay = o.get("payment") or _NO_PAYMENT
     order = {
         "_id": str(o["_id"]),
         "created_at": o.get("created_at"),
-        "created_at_str": _fmt_dt_local(o.get("created_at"), tz),
         "order_status": (o.get("order_status") or o.get("status") or "cart").lower(),
         "status": (o.get("order_status") or o.get("status") or "cart").lower(),
         "payment_status": (o.get("payment_status") or "unpaid").lower(),
         "payment": {
-            "payment_id": (o.get("payment") or {}).get("payment_id"),
-            "receipt_path": (o.get("payment") or {}).get("receipt_path"),
-            "seller_receipt_path": (o.get("payment") or {}).get("seller_receipt_path"),
-            "seller_receipt_sent_at": (o.get("payment") or {}).get("seller_receipt_sent_at"),
-            "rejected_reason": (o.get("payment") or {}).get("rejected_reason"),
-            "uploaded_at": (o.get("payment") or {}).get("uploaded_at"),
+            "payment_id": pay.get("payment_id"),
+            "receipt_path": pay.get("receipt_path"),
+            "seller_receipt_path": pay.get("seller_receipt_path"),
+            "seller_receipt_sent_at": pay.get("seller_receipt_sent_at"),
+            "rejected_reason": pay.get("rejected_reason"),
+            "uploaded_at": pay.get("uploaded_at"),
         },
         "items": items,
         "pharmacy_name": resolved_name or "Unknown Pharmacy",
         "pharmacy_address": o.get("pharmacy_address"),
         "ship_to": {"address": ship["address"], "city": ship["city"]},
         "formatted_total": o.get("formatted_total") or format_currency(total_amount),
-        "timeline": o.get("timeline", []),
 
         # >>> These two are what your template reads <<<
         "pharmacy_qr_url": pharmacy_qr_url,
@@ -946,7 +1188,7 @@ def buyer_order_detail(
 
     return templates.TemplateResponse(
         "buyer/order_detail.html",
-        {"request": request, "order": order, "current_user": current_user}
+        {"request": request, "order": order, "current_user": current_user, "tz": tz}
     )
 
 
@@ -960,13 +1202,14 @@ async def buyer_submit_and_upload(
     file: UploadFile = File(...),
     current_user: dict = Depends(require_role("buyer")),
 ):
-    db = get_database()
+    db = get_async_database()
+    now = _now()
     try:
         oid = _to_oid(order_id)
     except Exception:
         raise HTTPException(404, "Order not found")
 
-    o = db.Orders.find_one({"_id": oid, "buyer_id": current_user["id"]})
+    o = await db.Orders.find_one({"_id": oid, "buyer_id": current_user["id"]}, NO_TIMELINE)
     if not o:
         raise HTTPException(404, "Order not found")
 
@@ -974,61 +1217,72 @@ async def buyer_submit_and_upload(
         raise HTTPException(400, "Order not in a state that can be submitted")
 
     # Upload receipt first
-    receipt_path = _save_receipt(order_id, file)
+    receipt_path = await _save_receipt(order_id, file)
 
     # If coming from CART, reserve per line so we avoid oversell while pending
-    if (o.get("order_status") == "cart"):
-        reserved_mids: list[tuple[ObjectId, int]] = []
+    from_cart = o.get("order_status") == "cart"
+    reserved_mids: list[tuple[ObjectId, int]] = []
+    if from_cart:
         try:
             for it in (o.get("items") or []):
                 q = int(it.get("quantity", 0) or 0)
                 if q <= 0: 
                     continue
                 mid = _to_oid(_extract_item_mid(it))
-                if not _reserve_item(db, mid, q):
+                if not await _reserve_item(db, mid, q):
                     # rollback any prior reservations in this loop
                     for mid0, q0 in reserved_mids:
-                        try: _release_item(db, mid0, q0)
+                        try: await _release_item(db, mid0, q0)
                         except Exception: pass
                     raise HTTPException(409, f"Out of stock for {it.get('medicine_name','item')}")
                 reserved_mids.append((mid, q))
-
-            # Stamp reserved_qty == quantity on each item
-            fresh = db.Orders.find_one({"_id": oid}, {"items": 1}) or {}
-            new_items = []
-            for it in (fresh.get("items") or []):
-                it["reserved_qty"] = int(it.get("quantity", 0) or 0)
-                new_items.append(it)
-            db.Orders.update_one({"_id": oid}, {"$set": {"items": new_items}})
         except HTTPException:
             raise
         except Exception:
             # best-effort rollback
             for mid0, q0 in reserved_mids:
-                try: _release_item(db, mid0, q0)
+                try: await _release_item(db, mid0, q0)
                 except Exception: pass
             raise HTTPException(500, "Failed to reserve stock")
 
-    # Move to pending + proof_uploaded
-    db.Orders.update_one(
-        {"_id": oid},
+    # Move to pending + proof_uploaded, only if nobody moved the order meanwhile
+    sets = {
+        "order_status": "pending",
+        "status": "pending",
+        "payment_status": "proof_uploaded",
+        "payment.payment_id": payment_id,
+        "payment.receipt_path": receipt_path,
+        "payment.rejected_reason": None,
+        "payment.uploaded_at": now,
+        "shipping": {"address_line": address_line, "city": city},
+        "updated_at": now,
+    }
+    flt = {
+        "_id": oid,
+        "buyer_id": current_user["id"],
+        "order_status": o.get("order_status"),
+        "payment_status": {"$in": ["unpaid", "rejected"]},
+    }
+    if from_cart:
+        # cart lines are editable, so pin them to what was reserved
+        flt["items"] = o.get("items") or []
+        sets["items"] = [{**it, "reserved_qty": int(it.get("quantity", 0) or 0)} for it in flt["items"]]
+    moved = await db.Orders.find_one_and_update(
+        flt,
         {
-            "$set": {
-                "order_status": "pending",
-                "status": "pending",
-                "payment_status": "proof_uploaded",
-                "payment.payment_id": payment_id,
-                "payment.receipt_path": receipt_path,
-                "payment.rejected_reason": None,
-                "payment.uploaded_at": _now(),
-                "shipping": {"address_line": address_line, "city": city},
-                "updated_at": _now(),
-            },
-            "$push": {"timeline": {"ts": _now(), "actor": "buyer", "action": "submit_order",
-                                   "meta": {"payment_id": payment_id, "city": city}}},
+            "$set": sets,
+            "$push": _timeline_push(_audit_entry("buyer", "submit_order", {"payment_id": payment_id, "city": city}, now)),
         },
+        projection={"_id": 1},
     )
-    create_notification(
+    if moved is None:
+        for mid0, q0 in reserved_mids:
+            try: await _release_item(db, mid0, q0)
+            except Exception: pass
+        try: os.remove(receipt_path.lstrip("/"))
+        except OSError: pass
+        raise HTTPException(409, "Order changed, please try again")
+    await create_notification(
     db,
     user_id=o.get("pharmacy_id"),
     role="seller",
@@ -1036,49 +1290,51 @@ async def buyer_submit_and_upload(
     title="Payment proof uploaded",
     message=f"An order has a new payment proof from {current_user.get('username')}.",
     order_id=order_id,
+    now=now,
 )
     return RedirectResponse(f"/buyer/orders/{order_id}", status_code=303)
 
 
 @router.post("/buyer/orders/{order_id}/payment")
-def buyer_upload_payment(
+async def buyer_upload_payment(
     order_id: str,
     payment_id: str = Form(...),
     file: UploadFile = File(...),
     current_user: dict = Depends(require_role("buyer")),
 ):
-    db = get_database()
+    db = get_async_database()
+    now = _now()
     try:
         oid = _to_oid(order_id)
     except Exception:
         raise HTTPException(404, "Order not found")
 
-    o = db.Orders.find_one({"_id": oid, "buyer_id": current_user["id"]})
+    o = await db.Orders.find_one({"_id": oid, "buyer_id": current_user["id"]}, {"order_status": 1})
     if not o:
         raise HTTPException(404, "Order not found")
 
     if (o.get("order_status") or "").lower() not in ["pending", "confirmed"]:
         raise HTTPException(400, "Cannot upload payment in current status")
 
-    receipt_path = _save_receipt(order_id, file)
-    db.Orders.update_one(
+    receipt_path = await _save_receipt(order_id, file)
+    await db.Orders.update_one(
         {"_id": oid},
         {"$set": {
             "payment_status": "proof_uploaded",
             "payment.payment_id": payment_id,
             "payment.receipt_path": receipt_path,
             "payment.rejected_reason": None,
-            "payment.uploaded_at": _now(),
-            "updated_at": _now(),
-        }}
+            "payment.uploaded_at": now,
+            "updated_at": now,
+        },
+         "$push": _timeline_push(_audit_entry("buyer", "upload_payment", {"payment_id": payment_id}, now))}
     )
-    _audit(db, oid, "buyer", "upload_payment", {"payment_id": payment_id})
     return RedirectResponse(f"/buyer/orders/{order_id}", status_code=303)
 
 # ======================== SELLER FLOWS ========================
 
 @router.get("/seller/orders", response_class=HTMLResponse)
-def seller_orders_list(
+async def seller_orders_list(
     request: Request,
     status: Optional[str] = None,
     payment: Optional[str] = None,
@@ -1086,8 +1342,8 @@ def seller_orders_list(
     q: Optional[str] = None,
     current_user: dict = Depends(require_role("seller")),
 ):
-    db = get_database()
-    tz = _user_tz(request, db, current_user)
+    db = get_async_database()
+    tz = await _user_tz(request, db, current_user)
 
     filt: Dict[str, Any] = {"pharmacy_id": current_user["id"]}
     filt["$nor"] = [{"order_status": "cart", "payment_status": "unpaid"}]
@@ -1109,14 +1365,15 @@ def seller_orders_list(
             {"payment.payment_id": rx},
             {"items.medicine_name": rx},
         ])
-        prof_ids_str: List[str] = []
-        user_ids_str: List[str] = []
-        for p in db.user_profiles.find({"$or": [{"full_name": rx}, {"name": rx}]}, {"user_id": 1}):
-            if p.get("user_id"):
-                prof_ids_str.append(str(p["user_id"]))
-        for u in db.users.find({"$or": [{"full_name": rx}, {"name": rx}, {"username": rx}]}, {"_id": 1}):
-            user_ids_str.append(str(u["_id"]))
-        buyer_ids_str = list({*prof_ids_str, *user_ids_str})
+        # both name scans are unanchored regexes; run them side by side
+        profs, users = await asyncio.gather(
+            db.user_profiles.find({"$or": [{"full_name": rx}, {"name": rx}]}, {"user_id": 1}).to_list(length=None),
+            db.users.find({"$or": [{"full_name": rx}, {"name": rx}, {"username": rx}]}, {"_id": 1}).to_list(length=None),
+        )
+        buyer_ids_str = list({
+            *(str(p["user_id"]) for p in profs if p.get("user_id")),
+            *(str(u["_id"]) for u in users),
+        })
         if buyer_ids_str:
             or_terms.append({"buyer_id": {"$in": buyer_ids_str}})
     if or_terms:
@@ -1130,98 +1387,89 @@ def seller_orders_list(
     }
     sort_spec = sort_map.get(sort or "created_desc", [("created_at", -1)])
 
-    orders = list(db.Orders.find(filt).sort(sort_spec))
-    logger.info(f"[seller_list] found {len(orders)} orders for pharmacy_id={current_user['id']}")
+    page, size = _page_args(request)
+    orders, has_next = await _fetch_page(db.Orders.find(filt, SELLER_LIST_FIELDS).sort(sort_spec), page, size)
+    logger.debug("[seller_list] found %d orders for pharmacy_id=%s", len(orders), current_user["id"])
 
-    buyer_ids_in = list({o.get("buyer_id") for o in orders if o.get("buyer_id")})
-    profiles = {}
-    if buyer_ids_in:
-        for p in db.user_profiles.find({"user_id": {"$in": buyer_ids_in}}):
-            profiles[p.get("user_id")] = p
+    # resolve every buyer's display name up front instead of per order
+    buyer_names = await _lookup_buyer_names(db, (o.get("buyer_id") for o in orders))
 
     shaped = []
     for o in orders:
         buyer_id = o.get("buyer_id")
-        buyer_name, _, _ = _lookup_buyer_display(db, buyer_id) 
-        display_name = buyer_name or _short_id(buyer_id)
-        prof = profiles.get(o.get("buyer_id")) or {}
+        display_name = buyer_names.get(str(buyer_id)) if buyer_id else "—"
         
-        items_out = []
-        for it in (o.get("items") or []):
-            items_out.append({
-                "medicine_name": it.get("medicine_name", "Unknown"),
-                "quantity": int(it.get("quantity", 0) or 0),
-                "price": float(it.get("price", 0) or 0.0),
-            })
-
         ship = _extract_shipping(o)
         created_at = o.get("created_at")
         shaped.append({
             "_id": str(o["_id"]),
             "created_at": created_at,
-            "created_at_str": _fmt_dt_local(created_at, tz),
             "order_status": (o.get("order_status") or o.get("status") or "pending").lower(),
             "payment_status": (o.get("payment_status") or "unpaid").lower(),
-            "formatted_total": o.get("formatted_total") or format_currency(o.get("total_amount") or 0),
+            "formatted_total": o.get("formatted_total") or f"{o.get('total_amount') or 0:.2f}Ks",
             "buyer_display": display_name,            # <- now a real name when available
-            "items": items_out,
+            "items": o.get("items") or [],
             "address": ship["address"],
             "city": ship["city"],
         })
 
     return templates.TemplateResponse(
         "seller/orders_list.html",
-        {"request": request, "orders": shaped, "current_user": current_user,
+        {"request": request, "orders": shaped, "current_user": current_user, "tz": tz,
          "status": status or request.query_params.get("status", "") or "",
          "payment": payment or request.query_params.get("payment", "") or "",
-         "sort": sort or request.query_params.get("sort", "created_desc")},
+         "sort": sort or request.query_params.get("sort", "created_desc"),
+         "page": page, "has_next": has_next},
     )
 
 @router.get("/seller/orders/review", response_class=HTMLResponse)
-def seller_review_queue(request: Request, current_user: dict = Depends(require_role("seller"))):
-    db = get_database()
-    tz = _user_tz(request, db, current_user)
+async def seller_review_queue(request: Request, current_user: dict = Depends(require_role("seller"))):
+    db = get_async_database()
+    tz = await _user_tz(request, db, current_user)
 
     cur = db.Orders.find(
         {
             "pharmacy_id": current_user["id"],
             "payment_status": {"$in": ["proof_uploaded", "rejected"]},
             "order_status": {"$in": ["pending", "confirmed"]},
-        }
+        },
+        REVIEW_FIELDS,
     ).sort("updated_at", -1)
 
-    orders = list(cur)
+    page, size = _page_args(request)
+    orders, has_next = await _fetch_page(cur, page, size)
     shaped = []
     for o in orders:
+        pay = o.get("payment") or _NO_PAYMENT
         shaped.append({
             "_id": str(o["_id"]),
-            "buyer_id": o.get("buyer_id"),
-            "created_at_str": _fmt_dt_local(o.get("created_at"), tz),
-            "order_status": (o.get("order_status") or "pending").lower(),
-            "payment_status": (o.get("payment_status") or "unpaid").lower(),
-            "formatted_total": o.get("formatted_total") or format_currency(o.get("total_amount", 0)),
-            "payment_id": (o.get("payment") or {}).get("payment_id"),
-            "receipt_path": (o.get("payment") or {}).get("receipt_path"),
-            "rejected_reason": (o.get("payment") or {}).get("rejected_reason"),
+            "created_at": o.get("created_at"),
+            "formatted_total": o.get("formatted_total") or f"{o.get('total_amount') or 0:.2f}Ks",
+            "payment_id": pay.get("payment_id"),
+            "receipt_path": pay.get("receipt_path"),
+            "rejected_reason": pay.get("rejected_reason"),
         })
 
-    return templates.TemplateResponse("seller/review_list.html", {"request": request, "orders": shaped, "current_user": current_user})
+    return templates.TemplateResponse("seller/review_list.html", {"request": request, "orders": shaped, "current_user": current_user, "tz": tz,
+                                                                  "page": page, "has_next": has_next})
 
 @router.get("/seller/orders/{order_id}", response_class=HTMLResponse)
-def seller_order_detail(
+async def seller_order_detail(
     request: Request,
     order_id: str,
+    background_tasks: BackgroundTasks,
     current_user: dict = Depends(require_role("seller"))
 ):
-    db = get_database()
-    tz = _user_tz(request, db, current_user)
+    db = get_async_database()
+    now = _now()
+    tz = await _user_tz(request, db, current_user)
 
     try:
         oid = _to_oid(order_id)
     except Exception:
         raise HTTPException(404, "Order not found")
 
-    o = db.Orders.find_one({"_id": oid, "pharmacy_id": current_user["id"]})
+    o = await db.Orders.find_one({"_id": oid, "pharmacy_id": current_user["id"]}, NO_TIMELINE)
     if not o:
         raise HTTPException(404, "Order not found")
     
@@ -1229,38 +1477,23 @@ def seller_order_detail(
     if (o.get("order_status") or "").lower() == "cart" and (o.get("payment_status") or "").lower() == "unpaid":
         raise HTTPException(404, "Order not found")
 
-    buyer_name, buyer_phone, buyer_email = _lookup_buyer_display(db, o.get("buyer_id"))
+    buyer_name, buyer_phone, buyer_email = await _lookup_buyer_display(db, o.get("buyer_id"))
 
     ship = _extract_shipping(o)
 
     # items + revenue
-    items = []
-    revenue_total = 0.0
-    for it in (o.get("items") or []):
-        q = int(it.get("quantity", 0) or 0)
-        p_sell = float(it.get("price", 0) or 0.0)
-        p_buy = float(it.get("buying_price", 0) or 0.0)
-        line_total = q * p_sell
-        line_rev = (p_sell - p_buy) * q
-        revenue_total += line_rev
-        items.append({
-            "medicine_name": it.get("medicine_name", "Unknown"),
-            "quantity": q,
-            "price": p_sell,
-            "buying_price": p_buy,
-            "line_total": line_total,
-            "line_revenue": line_rev,
-        })
-
-    total_amount = o.get("total_amount")
-    if total_amount is None:
-        total_amount = sum(x["line_total"] for x in items)
+    items = o.get("items") or []
+    revenue_total = sum(
+        (float(it.get("price") or 0) - float(it.get("buying_price") or 0)) * int(it.get("quantity") or 0)
+        for it in items
+    )
+    total_amount = _order_total(o, items)
 
     order_status = (o.get("order_status") or o.get("status") or "pending").lower()
     payment_status = (o.get("payment_status") or "unpaid").lower()
-    pmt = (o.get("payment") or {})
-    voucher_generated = bool(((o.get("payment") or {}).get("seller_receipt_path")))
-    voucher_sent = bool(((o.get("payment") or {}).get("seller_receipt_sent_at")))
+    pmt = o.get("payment") or _NO_PAYMENT
+    voucher_generated = bool(pmt.get("seller_receipt_path"))
+    voucher_sent = bool(pmt.get("seller_receipt_sent_at"))
 
     actions = {
     "verify": {"can": (payment_status == "proof_uploaded"), "done": (payment_status == "paid")},
@@ -1273,16 +1506,14 @@ def seller_order_detail(
     },
 }
 
-    resolved_name = o.get("pharmacy_name") or _lookup_pharmacy_name(db, o.get("pharmacy_id") or o.get("seller_id"))
+    resolved_name = o.get("pharmacy_name") or await _lookup_pharmacy_name(db, o.get("pharmacy_id") or o.get("seller_id"))
     if resolved_name and resolved_name != o.get("pharmacy_name"):
-        db.Orders.update_one({"_id": o["_id"]}, {"$set": {"pharmacy_name": resolved_name, "updated_at": _now()}})
-    logger.info(f"[seller_detail] order={o.get('_id')} pid={o.get('pharmacy_id') or o.get('seller_id')} name={resolved_name}")
+        background_tasks.add_task(_set_pharmacy_name, o["_id"], resolved_name, now)
+    logger.debug("[seller_detail] order=%s pid=%s name=%s", o.get("_id"), o.get("pharmacy_id") or o.get("seller_id"), resolved_name)
 
     order = {
         "_id": str(o["_id"]),
         "created_at": o.get("created_at"),
-        "created_at_str": _fmt_dt_local(o.get("created_at"), tz),
-        "updated_at_str": _fmt_dt_local(o.get("updated_at"), tz),
         "order_status": order_status,
         "payment_status": payment_status,
         "payment": {
@@ -1299,101 +1530,116 @@ def seller_order_detail(
         "formatted_revenue_total": format_currency(revenue_total),
         "buyer": {"display": buyer_name, "phone": buyer_phone, "email": buyer_email},
         "ship_to": {"address": ship["address"], "city": ship["city"]},
-        "timeline": o.get("timeline", []),
         "actions": actions,
         "pharmacy_name": resolved_name or "Unknown Pharmacy",
     }
 
-    return templates.TemplateResponse("seller/order_detail.html", {"request": request, "order": order, "current_user": current_user})
+    return templates.TemplateResponse("seller/order_detail.html", {"request": request, "order": order, "current_user": current_user, "tz": tz})
 
 @router.post("/seller/orders/{order_id}/generate_receipt")
-def seller_generate_receipt(order_id: str, current_user: dict = Depends(require_role("seller"))):
-    db = get_database()
+async def seller_generate_receipt(order_id: str, current_user: dict = Depends(require_role("seller"))):
+    db = get_async_database()
     oid = _to_oid(order_id)
-    o = db.Orders.find_one({"_id": oid, "pharmacy_id": current_user["id"]})
+    o = await db.Orders.find_one({"_id": oid, "pharmacy_id": current_user["id"]}, NO_TIMELINE)
     if not o or (o.get("payment_status") or "").lower() != "paid":
         raise HTTPException(400, "Voucher can be generated only after payment is verified")
 
     # generate using the full DB order
-    generated_url = _generate_seller_receipt(db, o)
+    buyer_name, _, _ = await _lookup_buyer_display(db, o.get("buyer_id"))
+    generated_url = await run_in_threadpool(_generate_seller_receipt, o, buyer_name)
 
-    db.Orders.update_one(
+    now = _now()
+    await db.Orders.update_one(
         {"_id": oid},
-        {"$set": {"payment.seller_receipt_path": generated_url, "updated_at": _now()}}
+        {"$set": {"payment.seller_receipt_path": generated_url, "updated_at": now},
+         "$push": _timeline_push(_audit_entry("seller", "receipt_generated", {"path": generated_url}, now))}
     )
-    _audit(db, oid, "seller", "receipt_generated", {"path": generated_url})
     return RedirectResponse(f"/seller/orders/{order_id}", status_code=303)
 
 
 @router.post("/seller/orders/{order_id}/send_receipt")
-def seller_send_receipt(order_id: str, current_user: dict = Depends(require_role("seller"))):
-    db = get_database()
+async def seller_send_receipt(order_id: str, current_user: dict = Depends(require_role("seller"))):
+    db = get_async_database()
     oid = _to_oid(order_id)
-    o = db.Orders.find_one({"_id": oid, "pharmacy_id": current_user["id"]})
+    o = await db.Orders.find_one({"_id": oid, "pharmacy_id": current_user["id"]}, {"payment_status": 1, "payment.seller_receipt_path": 1})
     if not o or (o.get("payment_status") or "").lower() != "paid":
         raise HTTPException(400, "Send only after payment is verified")
 
-    path = ((o or {}).get("payment") or {}).get("seller_receipt_path")
+    path = (o.get("payment") or _NO_PAYMENT).get("seller_receipt_path")
     if not path:
         raise HTTPException(400, "Generate the voucher first")
 
-    # notify + mark as sent
-    notify_buyer_with_receipt(db, o, path)
-    _audit(db, oid, "seller", "receipt_sent", {"path": path})
+    # notify + mark as sent (records seller_receipt_sent on the timeline)
+    await notify_buyer_with_receipt(db, o, path)
     return RedirectResponse(f"/seller/orders/{order_id}", status_code=303)
 
 
 @router.post("/seller/orders/{order_id}/verify")
-def seller_verify_payment(order_id: str, current_user: dict = Depends(require_role("seller"))):
+async def seller_verify_payment(order_id: str, current_user: dict = Depends(require_role("seller"))):
     """proof_uploaded → (commit stock) → paid + confirmed; then prepare seller receipt."""
-    db = get_database()
+    db = get_async_database()
+    now = _now()
     try:
         oid = _to_oid(order_id)
     except Exception:
         raise HTTPException(404, "Order not found")
 
-    o = db.Orders.find_one({"_id": oid, "pharmacy_id": current_user["id"]})
-    if not o:
-        raise HTTPException(404, "Order not found")
-
-    if (o.get("payment_status") or "").lower() != "proof_uploaded":
-        raise HTTPException(400, "No proof to verify")
-
-    # Commit all reserved quantities to real stock BEFORE flipping to paid
-    for it in (o.get("items") or []):
-        q = int(it.get("reserved_qty", it.get("quantity", 0)) or 0)
-        if q <= 0: 
-            continue
-        ok = _commit_item(db, _to_oid(_extract_item_mid(it)), q)
-        if not ok:
-            logger.error("Stock commit failed mid=%s qty=%s", it.get("medicine_id"), q)
-            raise HTTPException(409, "Stock commit failed")
-
-    # Mark as paid + confirmed
-    db.Orders.update_one(
-        {"_id": oid},
+    # Claim the proof_uploaded → paid transition atomically so two sellers
+    # can't both commit stock for the same order
+    o2 = await db.Orders.find_one_and_update(
+        {"_id": oid, "pharmacy_id": current_user["id"], "payment_status": "proof_uploaded"},
         {
             "$set": {
                 "payment_status": "paid",
                 "order_status": "confirmed",
                 "status": "confirmed",
-                "updated_at": _now(),
+                "updated_at": now,
             },
-            "$push": {"timeline": {"ts": _now(), "actor": "seller", "action": "payment_verified"}},
+            "$push": _timeline_push(_audit_entry("seller", "payment_verified", ts=now)),
         },
+        projection=NO_TIMELINE,
+        return_document=ReturnDocument.AFTER,
     )
-    create_notification(
+    if o2 is None:
+        if not await db.Orders.count_documents({"_id": oid, "pharmacy_id": current_user["id"]}, limit=1):
+            raise HTTPException(404, "Order not found")
+        raise HTTPException(400, "No proof to verify")
+
+    # Commit all reserved quantities to real stock; undo the claim on failure
+    committed: list[tuple[ObjectId, int]] = []
+    for it in (o2.get("items") or []):
+        q = int(it.get("reserved_qty", it.get("quantity", 0)) or 0)
+        if q <= 0: 
+            continue
+        mid = _to_oid(_extract_item_mid(it))
+        ok = await _commit_item(db, mid, q)
+        if ok:
+            committed.append((mid, q))
+        else:
+            logger.error("Stock commit failed mid=%s qty=%s", it.get("medicine_id"), q)
+            # lines committed before this one go back to reserved
+            for mid0, q0 in committed:
+                try: await _uncommit_item(db, mid0, q0)
+                except Exception: logger.exception("Stock uncommit failed mid=%s qty=%s", mid0, q0)
+            await db.Orders.update_one(
+                {"_id": oid, "payment_status": "paid"},
+                {"$set": {"payment_status": "proof_uploaded", "order_status": "pending",
+                          "status": "pending", "updated_at": now},
+                 "$push": _timeline_push(_audit_entry("system", "stock_commit_failed", {"medicine_id": it.get("medicine_id")}, now))},
+            )
+            raise HTTPException(409, "Stock commit failed")
+
+    await create_notification(
     db,
-    user_id=o.get("buyer_id"),
+    user_id=o2.get("buyer_id"),
     role="buyer",
     type_="payment_verified",
     title="Payment verified",
     message=f"Your order {order_id} payment was verified. We are preparing your items.",
     order_id=order_id,
+    now=now,
 )
 
-    # Re-fetch minimal fields for receipt
-    o2 = db.Orders.find_one({"_id": oid})
     shaped_for_pdf = {
         "_id": o2["_id"],
         "created_at": o2.get("created_at"),
@@ -1401,7 +1647,7 @@ def seller_verify_payment(order_id: str, current_user: dict = Depends(require_ro
         "items": o2.get("items", []),
         "total_amount": o2.get("total_amount"),
         "formatted_total": o2.get("formatted_total") or format_currency(o2.get("total_amount") or 0),
-        "buyer": {"display": (_lookup_buyer_display(db, o2.get("buyer_id"))[0])},
+        "buyer": {"display": (await _lookup_buyer_display(db, o2.get("buyer_id")))[0]},
         "ship_to": (lambda s: {
             "address": (s or {}).get("address") or (s or {}).get("address_line") or (s or {}).get("line1"),
             "city": (s or {}).get("city"),
@@ -1410,20 +1656,19 @@ def seller_verify_payment(order_id: str, current_user: dict = Depends(require_ro
 
     # Generate seller receipt (best-effort)
     try:
-        seller_receipt_path = _generate_seller_receipt(db, o2)
+        seller_receipt_path = await run_in_threadpool(_generate_seller_receipt, o2, shaped_for_pdf["buyer"]["display"])
     except Exception:
         logger.exception("Failed generating seller receipt")
         seller_receipt_path = None
 
-    db.Orders.update_one(
+    await db.Orders.update_one(
         {"_id": oid},
         {
             "$set": {
                 "payment.seller_receipt_path": seller_receipt_path,
-                "payment.seller_receipt_uploaded_at": _now(),
+                "payment.seller_receipt_uploaded_at": now,
             },
-            "$push": {"timeline": {"ts": _now(), "actor": "system", "action": "seller_receipt_ready",
-                                   "meta": {"path": seller_receipt_path}}},
+            "$push": _timeline_push(_audit_entry("system", "seller_receipt_ready", {"path": seller_receipt_path}, now)),
         },
     )
 
@@ -1432,26 +1677,26 @@ def seller_verify_payment(order_id: str, current_user: dict = Depends(require_ro
 
 
 @router.post("/seller/orders/{order_id}/reject")
-def seller_reject_payment(order_id: str, reason: str = Form(...), current_user: dict = Depends(require_role("seller"))):
+async def seller_reject_payment(order_id: str, reason: str = Form(...), current_user: dict = Depends(require_role("seller"))):
     if not reason.strip():
         raise HTTPException(400, "Reason is required")
 
-    db = get_database()
+    db = get_async_database()
+    now = _now()
     try:
         oid = _to_oid(order_id)
     except Exception:
         raise HTTPException(404, "Order not found")
 
-    o = db.Orders.find_one({"_id": oid, "pharmacy_id": current_user["id"]})
+    o = await db.Orders.find_one_and_update(
+        {"_id": oid, "pharmacy_id": current_user["id"]},
+        {"$set": {"payment_status": "rejected", "payment.rejected_reason": reason, "updated_at": now},
+         "$push": _timeline_push(_audit_entry("seller", "payment_rejected", {"reason": reason}, now))},
+        projection={"buyer_id": 1},
+    )
     if not o:
         raise HTTPException(404, "Order not found")
-
-    db.Orders.update_one(
-        {"_id": oid},
-        {"$set": {"payment_status": "rejected", "payment.rejected_reason": reason, "updated_at": _now()},
-         "$push": {"timeline": {"ts": _now(), "actor": "seller", "action": "payment_rejected", "meta": {"reason": reason}}}}
-    )
-    create_notification(
+    await create_notification(
     db,
     user_id=o.get("buyer_id"),
     role="buyer",
@@ -1459,35 +1704,35 @@ def seller_reject_payment(order_id: str, reason: str = Form(...), current_user:
     title="Payment rejected",
     message=f"Your order {order_id} payment was rejected.",
     order_id=order_id,
+    now=now,
 )
     return RedirectResponse(f"/seller/orders/{order_id}", status_code=303)
 
 @router.post("/seller/orders/{order_id}/delivered")
-def seller_mark_delivered(order_id: str, current_user: dict = Depends(require_role("seller"))):
-    db = get_database()
+async def seller_mark_delivered(order_id: str, current_user: dict = Depends(require_role("seller"))):
+    db = get_async_database()
+    now = _now()
     try:
         oid = _to_oid(order_id)
     except Exception:
         raise HTTPException(404, "Order not found")
 
-    o = db.Orders.find_one({"_id": oid, "pharmacy_id": current_user["id"]})
+    o = await db.Orders.find_one_and_update(
+        {"_id": oid, "pharmacy_id": current_user["id"],
+         "payment_status": "paid", "order_status": {"$in": ["confirmed", "dispatched"]}},
+        {"$set": {"order_status": "delivered", "status": "delivered", "delivered": {"ts": now}, "updated_at": now},
+         "$push": _timeline_push(_audit_entry("seller", "delivered", ts=now))},
+        projection={"buyer_id": 1},
+    )
     if not o:
-        raise HTTPException(404, "Order not found")
-
-    order_status = (o.get("order_status") or "").lower()
-    payment_status = (o.get("payment_status") or "").lower()
-
-    if payment_status != "paid":
-        raise HTTPException(400, "Payment must be verified before delivery")
-    if order_status not in ["confirmed", "dispatched"]:
+        # only the failure path pays for a second read, to pick the message
+        cur = await db.Orders.find_one({"_id": oid, "pharmacy_id": current_user["id"]}, {"order_status": 1, "payment_status": 1})
+        if not cur:
+            raise HTTPException(404, "Order not found")
+        if (cur.get("payment_status") or "").lower() != "paid":
+            raise HTTPException(400, "Payment must be verified before delivery")
         raise HTTPException(400, "Order must be confirmed or dispatched to mark delivered")
-
-    db.Orders.update_one(
-        {"_id": oid},
-        {"$set": {"order_status": "delivered", "status": "delivered", "delivered": {"ts": _now()}, "updated_at": _now()},
-         "$push": {"timeline": {"ts": _now(), "actor": "seller", "action": "delivered"}}}
-    )
-    create_notification(
+    await create_notification(
     db,
     user_id=o.get("buyer_id"),
     role="buyer",
@@ -1495,5 +1740,6 @@ def seller_mark_delivered(order_id: str, current_user: dict = Depends(require_ro
     title="Order delivered",
     message=f"Order {order_id} has been delivered. Thank you!",
     order_id=order_id,
+    now=now,
 )
     return RedirectResponse(f"/seller/orders/{order_id}", status_code=303)
@@ -1,26 +1,19 @@
 from fastapi import APIRouter, Request, Form, UploadFile, File, HTTPException
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from fastapi.responses import RedirectResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.concurrency import run_in_threadpool
+from templating import templates
 from datetime import datetime
-from database import get_database
-from passlib.context import CryptContext
+from database import get_database, get_async_database
+from auth import get_password_hash, verify_password, password_needs_rehash, get_user_by_username, invalidate_user_cache
+from utils import geo_point
 import os
 import shutil
-from math import sqrt, cos
 import re
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
-
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
-
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
 
 @router.get("/register")
 def register_role_selection(request: Request):  # ADD THIS FUNCTION
@@ -67,6 +60,15 @@ def normalize_township(name: str):
 # -----------------------------
 # Geocoding function
 # -----------------------------
+# Shared session so registrations reuse the keep-alive connection (and TLS
+# handshake) to Nominatim; transient failures get two quick retries.
+_geo_session = requests.Session()
+_geo_session.headers["User-Agent"] = "MedicineTracker/1.0"
+_geo_session.mount("https://", HTTPAdapter(
+    pool_connections=10, pool_maxsize=20,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504)),
+))
+
 def geocode_address(address: str):
     """
     Return township, latitude, longitude.
@@ -77,10 +79,9 @@ def geocode_address(address: str):
 
     url = "https://nominatim.openstreetmap.org/search"
     params = {"q": address, "format": "json", "limit": 1, "addressdetails": 1}
-    headers = {"User-Agent": "MedicineTracker/1.0"}
 
     try:
-        response = requests.get(url, params=params, headers=headers, timeout=5)
+        response = _geo_session.get(url, params=params, timeout=5)
         data = response.json()
         if data and len(data) > 0:
             lat = float(data[0]["lat"])
@@ -110,42 +111,6 @@ def geocode_address(address: str):
     # Fallback: return None if township cannot be determined
     return None, None, None
 
-# -----------------------------
-# Distance calculation
-# -----------------------------
-def simple_distance_km(lat1, lon1, lat2, lon2):
-    lat_km = (lat2 - lat1) * 111
-    lon_km = (lon2 - lon1) * 111 * cos(lat1 * 3.14159265 / 180)
-    return sqrt(lat_km**2 + lon_km**2)
-
-# -----------------------------
-# Nearest pharmacies
-# -----------------------------
-def get_nearest_pharmacies(user_township, user_lat, user_lon, db, limit=5):
-    pharmacies = list(db.pharmacy_profiles.find({}))
-    results = []
-
-    for pharmacy in pharmacies:
-        pharmacy_township = pharmacy.get("township")
-        ph_lat = pharmacy["coordinates"]["latitude"]
-        ph_lon = pharmacy["coordinates"]["longitude"]
-
-        # If township matches, distance = 0
-        if pharmacy_township and user_township and pharmacy_township.lower() == user_township.lower():
-            distance = 0
-        else:
-            distance = simple_distance_km(user_lat, user_lon, ph_lat, ph_lon)
-
-        results.append({
-            "pharmacy_name": pharmacy["pharmacy_name"],
-            "address": pharmacy["address"],
-            "township": pharmacy_township,
-            "distance_km": round(distance, 2)
-        })
-
-    results.sort(key=lambda x: x["distance_km"])
-    return results[:limit]
-
 # -----------------------------
 # Registration routes
 # -----------------------------
@@ -189,6 +154,7 @@ async def register_seller(
     sun_end: str = Form(None),
 ):
     db = get_database()
+    now = datetime.utcnow()
 
     # Basic validations
     if password != confirm_password:
@@ -215,15 +181,16 @@ async def register_seller(
         counter += 1
 
     # Create user
-    hashed = get_password_hash(password)
+    hashed = await run_in_threadpool(get_password_hash, password)
     user_data = {
         "username": username,
         "password": hashed,
         "role": "seller",
         "is_profile_complete": True,
-        "created_at": datetime.utcnow()
+        "created_at": now
     }
     user_result = db.users.insert_one(user_data)
+    invalidate_user_cache(username)
 
     # Assemble operating hours dict
     operating_hours = {}
@@ -254,7 +221,7 @@ async def register_seller(
     if qrCode:
         upload_dir = os.path.join(os.getcwd(), "static", "qr_codes")
         os.makedirs(upload_dir, exist_ok=True)
-        safe_name = f"{int(datetime.utcnow().timestamp())}_{qrCode.filename}"
+        safe_name = f"{int(now.timestamp())}_{qrCode.filename}"
         dest_path = os.path.join(upload_dir, safe_name)
         with open(dest_path, "wb") as buffer:
             shutil.copyfileobj(qrCode.file, buffer)
@@ -273,8 +240,10 @@ async def register_seller(
         "latitude": lat,
         "longitude": lon,
         "operating_hours": operating_hours,
-        "created_at": datetime.utcnow()
+        "created_at": now
     }
+    if lat is not None and lon is not None:
+        pharmacy_profile_data["location"] = geo_point(lat, lon)
     db.pharmacy_profiles.insert_one(pharmacy_profile_data)
 
     return RedirectResponse(url="/?registered=seller", status_code=302)
@@ -287,54 +256,6 @@ def register_buyer_form(request: Request):
 # -----------------------------
 # Buyer registration
 # -----------------------------
-# @router.post("/register/buyer")
-# def register_buyer(
-#     request: Request,
-#     username: str = Form(...),
-#     password: str = Form(...),
-#     phone: str = Form(...),
-#     township: str = Form(...),
-#     address: str = Form(...)
-# ):
-#     db = get_database()
-#     print("📌 Connected DB:", db.name)   # Debug database name
-
-#     if db.users.find_one({"username": username}):
-#         print("❌ Username exists:", username)
-#         return templates.TemplateResponse("register_buyer.html", {
-#             "request": request,
-#             "error": "Username already exists."
-#         })
-
-#     township, lat, lon = geocode_address(address)
-#     if not township:
-#         print("❌ Invalid township:", address)
-#         return templates.TemplateResponse("register_buyer.html", {"request": request, "error": "Invalid township"})
-
-#     user_data = {
-#         "username": username,
-#         "password": get_password_hash(password),
-#         "role": "buyer",
-#         "is_profile_complete": True,
-#         "created_at": datetime.utcnow()
-#     }
-#     user_result = db.users.insert_one(user_data)
-#     print("✅ User inserted with ID:", user_result.inserted_id)
-
-#     buyer_profile_data = {
-#         "user_id": str(user_result.inserted_id),
-#         "username": username,
-#         "phone": phone,
-#         "address": address,
-#         "township": township,
-#         "coordinates": {"latitude": lat, "longitude": lon} if lat and lon else {},
-#         "favorite_pharmacies": [],
-#         "created_at": datetime.utcnow()
-#     }
-#     profile_result = db.buyer_profiles.insert_one(buyer_profile_data)
-#     print("✅ Buyer profile inserted with ID:", profile_result.inserted_id)
-
-#     return RedirectResponse(url="/?registered=buyer", status_code=302)
 @router.post("/register/buyer")
 def register_buyer(
     request: Request,
@@ -345,6 +266,7 @@ def register_buyer(
     address: str = Form(...)
 ):
     db = get_database()
+    now = datetime.utcnow()
     print("📌 Connected DB:", db.name)   # Debug database name
 
     # Check if username exists
@@ -368,9 +290,10 @@ def register_buyer(
         "password": hashed_password,
         "role": "buyer",
         "is_profile_complete": True,
-        "created_at": datetime.utcnow()
+        "created_at": now
     }
     user_result = db.users.insert_one(user_data)
+    invalidate_user_cache(username)
     print("✅ User inserted with ID:", user_result.inserted_id)
 
     # Geocode address after confirming username is unique
@@ -384,7 +307,7 @@ def register_buyer(
         "township": normalized_township or township,
         "coordinates": {"latitude": lat, "longitude": lon} if lat and lon else {},
         "favorite_pharmacies": [],
-        "created_at": datetime.utcnow()
+        "created_at": now
     }
     db.buyer_profiles.insert_one(buyer_profile_data)
 
@@ -400,11 +323,17 @@ def register_buyer(
 # -----------------------------
 @router.post("/login")
 async def login(request: Request, username: str = Form(...), password: str = Form(...)):
-    db = get_database()
-    user = db.users.find_one({"username": username})
-    if not user or not verify_password(password, user["password"]):
+    user = await get_user_by_username(username)
+    # argon2 is deliberately slow and memory-hard; keep it off the event loop
+    if not user or not await run_in_threadpool(verify_password, password, user["password"]):
         return templates.TemplateResponse("login.html", {"request": request, "error": "Invalid credentials"})
 
+    # migrate legacy bcrypt hashes to the current default scheme
+    if password_needs_rehash(user["password"]):
+        new_hash = await run_in_threadpool(get_password_hash, password)
+        await get_async_database().users.update_one({"_id": user["_id"]}, {"$set": {"password": new_hash}})
+        invalidate_user_cache(username)
+
     request.session["user"] = {"username": user["username"], "role": user["role"], "id": str(user["_id"]), "is_profile_complete": user.get("is_profile_complete", False)}
     if user["role"] == "buyer":
         return RedirectResponse(url="/buyer/home", status_code=302)
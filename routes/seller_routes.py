@@ -1,16 +1,22 @@
-from fastapi import APIRouter, Request, Form, Depends
+from fastapi import APIRouter, Request, Form, Depends, BackgroundTasks
 from fastapi.responses import RedirectResponse, HTMLResponse
 from fastapi import HTTPException, status
-from fastapi.templating import Jinja2Templates
+from templating import templates
 from fastapi import Form, Request, File, UploadFile
 from datetime import datetime
 from bson import ObjectId
+from pymongo import ReturnDocument
 from pathlib import Path
-from database import get_database
+from database import get_database, get_async_database
 from auth import require_role
+from utils import geo_point
+from routes.buyer_routes import geocode_address
+from routes.order_routes import forget_pharmacy_name
 
+import contextlib
 import os
 import uuid
+import aiofiles
 
 from fastapi import HTTPException, status, UploadFile, File, Form
 from fastapi.responses import JSONResponse
@@ -27,11 +33,29 @@ class JSONEncoder(json.JSONEncoder):
 
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
 
 # Create images directory if it doesn't exist
 MEDICINE_IMAGES_DIR = "static/images/medicines"
 Path(MEDICINE_IMAGES_DIR).mkdir(parents=True, exist_ok=True)
+IMAGE_CHUNK = 1 << 20
+IMAGE_MAX_BYTES = 10 * 1024 * 1024
+IMAGE_EXTS = frozenset({".jpg", ".jpeg", ".png", ".gif", ".webp"})
+
+async def _write_upload(upload: UploadFile, path: str) -> None:
+    # copy in chunks so an image never sits in memory whole
+    size = 0
+    try:
+        async with aiofiles.open(path, "wb") as buffer:
+            while chunk := await upload.read(IMAGE_CHUNK):
+                size += len(chunk)
+                if size > IMAGE_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="Image is too large (max 10 MB)")
+                await buffer.write(chunk)
+    except Exception:
+        # open() itself may have failed; don't mask that error
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        raise
 
 ####################################################################################
 # redirect to seller profile
@@ -222,9 +246,10 @@ def seller_inventory(request: Request, current_user: dict = Depends(require_role
         medicines_list = list(medicines_cursor)
         print(f"✅ Found {len(medicines_list)} medicines")
         
-        # 4. Process medicines data for template
+        # 4. Process medicines data for template (summary counts tallied in the same pass)
         processed_medicines = []
         current_date = datetime.utcnow().date()
+        in_stock_count = low_stock_count = out_of_stock_count = expired_count = 0
         
         for medicine in medicines_list:
             # Convert ObjectId to string for template
@@ -232,41 +257,39 @@ def seller_inventory(request: Request, current_user: dict = Depends(require_role
             medicine_dict["_id"] = str(medicine["_id"])
             
             # Convert expiration_date to date object if it's datetime
-            if isinstance(medicine.get("expiration_date"), datetime):
-                expiration_date = medicine["expiration_date"].date()
+            exp = medicine.get("expiration_date")
+            if isinstance(exp, datetime):
+                expiration_date = exp.date()
                 medicine_dict["expiration_date"] = expiration_date.strftime("%Y-%m-%d")
             else:
-                expiration_date = datetime.strptime(medicine["expiration_date"], "%Y-%m-%d").date()
+                expiration_date = datetime.strptime(exp, "%Y-%m-%d").date()
             
             # Calculate status flags
             stock = medicine.get("stock", 0)
             is_expired = expiration_date < current_date
             is_low_stock = 0 < stock <= 10  # Low stock if between 1-10
             is_out_of_stock = stock == 0     # Out of stock if 0
+            image_filename = medicine.get("image_filename")
             
             # Add calculated fields
-            medicine_dict["is_expired"] = is_expired
-            medicine_dict["is_low_stock"] = is_low_stock
-            medicine_dict["is_out_of_stock"] = is_out_of_stock
-            medicine_dict["formatted_buying_price"] = f"{medicine.get('buying_price', 0):.2f}"
-            medicine_dict["formatted_selling_price"] = f"{medicine.get('selling_price', 0):.2f}"
-            
-            # Add image URL if image exists
-            if medicine.get("image_filename"):
-                medicine_dict["image_url"] = f"/static/images/medicines/{medicine['image_filename']}"
-            else:
-                medicine_dict["image_url"] = "/static/images/placeholder-medicine.png"  # Default placeholder
-            
+            medicine_dict.update(
+                is_expired=is_expired,
+                is_low_stock=is_low_stock,
+                is_out_of_stock=is_out_of_stock,
+                formatted_buying_price=f"{medicine.get('buying_price', 0):.2f}",
+                formatted_selling_price=f"{medicine.get('selling_price', 0):.2f}",
+                image_url=(f"/static/images/medicines/{image_filename}" if image_filename
+                           else "/static/images/placeholder-medicine.png"),  # Default placeholder
+            )
             processed_medicines.append(medicine_dict)
-            print(f"📦 Processed medicine: {medicine['name']} - Stock: {stock}, "
-                  f"Expired: {is_expired}, Out of Stock: {is_out_of_stock}")
+            
+            in_stock_count += stock > 10
+            low_stock_count += is_low_stock
+            out_of_stock_count += is_out_of_stock
+            expired_count += is_expired
         
-        # 5. Calculate summary statistics
+        # 5. Summary statistics
         total_medicines = len(processed_medicines)
-        in_stock_count = sum(1 for med in processed_medicines if med.get("stock", 0) > 10)
-        low_stock_count = sum(1 for med in processed_medicines if med.get("is_low_stock", False))
-        out_of_stock_count = sum(1 for med in processed_medicines if med.get("stock", 0) == 0)
-        expired_count = sum(1 for med in processed_medicines if med.get("is_expired", False))
         
         print(f"📊 Summary - Total: {total_medicines}, In Stock: {in_stock_count}, "
               f"Low Stock: {low_stock_count}, Out of Stock: {out_of_stock_count}, "
@@ -396,10 +419,9 @@ async def seller_add_medicine(
             print(f"🔹 Processing image upload: {medicine_image.filename}")
             
             # Validate file type
-            allowed_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
             file_extension = Path(medicine_image.filename).suffix.lower()
             
-            if file_extension not in allowed_extensions:
+            if file_extension not in IMAGE_EXTS:
                 print("❌ Invalid file type")
                 return templates.TemplateResponse("seller/add_medicine.html", {
                     "request": request,
@@ -414,9 +436,7 @@ async def seller_add_medicine(
             image_path = os.path.join(MEDICINE_IMAGES_DIR, image_filename)
             
             # Save the image file
-            with open(image_path, "wb") as buffer:
-                content = await medicine_image.read()
-                buffer.write(content)
+            await _write_upload(medicine_image, image_path)
             
             print(f"✅ Image saved: {image_filename}")
         
@@ -445,6 +465,7 @@ async def seller_add_medicine(
             "seller_id": current_user["id"],
             "name": name,
             "stock": stock,
+            "available": stock,
             "buying_price": buying_price,
             "selling_price": selling_price,
             "expiration_date": expiration_dt,
@@ -479,6 +500,9 @@ async def seller_add_medicine(
             "form_data": form_data
         })
         
+    except HTTPException:
+        raise
+
     except Exception as e:
         print(f"❌ Unexpected error: {type(e).__name__}: {e}")
         import traceback
@@ -585,12 +609,6 @@ async def update_medicine(
         
         # Handle image upload
         if medicine_image and medicine_image.filename:
-            # Delete old image if exists
-            if medicine.get("image_filename"):
-                old_image_path = os.path.join("static/images/medicines", medicine["image_filename"])
-                if os.path.exists(old_image_path):
-                    os.remove(old_image_path)
-            
             # Save new image
             file_extension = os.path.splitext(medicine_image.filename)[1].lower()
             unique_id = uuid.uuid4().hex[:8]
@@ -598,16 +616,24 @@ async def update_medicine(
             image_filename = f"{current_user['id']}_{unique_id}_{sanitized_name}{file_extension}"
             image_path = os.path.join("static/images/medicines", image_filename)
             
-            with open(image_path, "wb") as buffer:
-                content = await medicine_image.read()
-                buffer.write(content)
+            await _write_upload(medicine_image, image_path)
+            
+            # Delete old image only once the new one is on disk
+            if medicine.get("image_filename"):
+                old_image_path = os.path.join("static/images/medicines", medicine["image_filename"])
+                if os.path.exists(old_image_path):
+                    os.remove(old_image_path)
             
             update_data["image_filename"] = image_filename
         
-        # Update database
+        # Update database; available is derived from the reserved count at
+        # write time, so a concurrent reserve/release can't leave it stale
         result = db.Medicine.update_one(
             {"_id": ObjectId(medicine_id)},
-            {"$set": update_data}
+            [{"$set": {
+                **{k: {"$literal": v} for k, v in update_data.items()},
+                "available": {"$subtract": [stock, {"$ifNull": ["$reserved", 0]}]},
+            }}]
         )
         
         if result.modified_count == 1:
@@ -615,6 +641,8 @@ async def update_medicine(
         else:
             request.session["flash_error"] = "Failed to update medicine"
             
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Error updating medicine: {e}")
         request.session["flash_error"] = "Error updating medicine"
@@ -622,7 +650,7 @@ async def update_medicine(
     return RedirectResponse(url="/seller/inventory", status_code=303)
     
 ####################################################################################
-def update_pharmacy_coordinates(db, pharmacy_profile, force_update=False):
+async def update_pharmacy_coordinates(db, pharmacy_profile, force_update=False):
     """
     Ensure pharmacy coordinates exist.
     - If coordinates exist and force_update=False → return them
@@ -634,11 +662,14 @@ def update_pharmacy_coordinates(db, pharmacy_profile, force_update=False):
 
     address = pharmacy_profile.get("address")
     if address:
-        lat, lon = geocode_address(address)
+        lat, lon = await geocode_address(address)
         if lat is not None and lon is not None:
-            db.pharmacy_profiles.update_one(
+            await db.pharmacy_profiles.update_one(
                 {"_id": pharmacy_profile["_id"]},
-                {"$set": {"coordinates": {"latitude": lat, "longitude": lon}}}
+                {"$set": {
+                    "coordinates": {"latitude": lat, "longitude": lon},
+                    "location": geo_point(lat, lon),
+                }}
             )
             return lat, lon
     return None, None
@@ -649,7 +680,7 @@ def seller_profile_edit(request: Request, current_user: dict = Depends(require_r
         return RedirectResponse(url="/seller/profile", status_code=302)
 
     db = get_database()
-    profile = db.pharmacy_profiles.find_one({"user_id": current_user["_id"]})
+    profile = db.pharmacy_profiles.find_one({"user_id": current_user["id"]})
 
     return request.app.state.templates.TemplateResponse("seller/profile_edit.html", {
         "request": request,
@@ -658,8 +689,9 @@ def seller_profile_edit(request: Request, current_user: dict = Depends(require_r
     })
 
 @router.post("/seller/profile/update")
-def update_seller_profile(
+async def update_seller_profile(
     request: Request,
+    background_tasks: BackgroundTasks,
     pharmacy_name: str = Form(...),
     license_number: str = Form(...),
     contact_info: str = Form(...),
@@ -670,7 +702,7 @@ def update_seller_profile(
     description: str = Form(""),
     current_user: dict = Depends(require_role("seller"))
 ):
-    db = get_database()
+    db = get_async_database()
 
     update_data = {
         "pharmacy_name": pharmacy_name,
@@ -689,10 +721,15 @@ def update_seller_profile(
         update_data["description"] = description
 
     # Update profile
-    db.pharmacy_profiles.update_one({"user_id": current_user["_id"]}, {"$set": update_data})
-
-    # ✅ Force update coordinates if address changed
-    pharmacy_profile = db.pharmacy_profiles.find_one({"user_id": current_user["_id"]})
-    update_pharmacy_coordinates(db, pharmacy_profile, force_update=True)
+    pharmacy_profile = await db.pharmacy_profiles.find_one_and_update(
+        {"user_id": current_user["id"]},
+        {"$set": update_data},
+        return_document=ReturnDocument.AFTER,
+    )
+    forget_pharmacy_name(current_user["id"])
+
+    # ✅ Force update coordinates after the response is sent (async geocoder)
+    if pharmacy_profile:
+        background_tasks.add_task(update_pharmacy_coordinates, db, pharmacy_profile, force_update=True)
 
     return RedirectResponse(url="/seller/home", status_code=302)
@@ -0,0 +1,33 @@
+import os
+
+from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache, TemplateError
+
+from config import get_settings
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(BASE_DIR, "templates")
+CACHE_DIR = os.path.join(BASE_DIR, ".jinja_cache")
+
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+# One environment for the whole app: compiled templates are shared by every
+# router and persisted to disk so new workers skip the parse/compile step.
+# auto_reload stats each template file on render; only worth it in dev.
+templates = Jinja2Templates(
+    directory=TEMPLATE_DIR,
+    bytecode_cache=FileSystemBytecodeCache(CACHE_DIR),
+    auto_reload=get_settings().TEMPLATES_AUTO_RELOAD,
+)
+
+
+def warm_templates() -> None:
+    """Compile every template once at startup (filling the in-memory and
+    bytecode caches) so no request pays for the first parse."""
+    env = templates.env
+    for name in env.list_templates(extensions=["html"]):
+        try:
+            env.get_template(name)
+        except TemplateError:
+            # a broken template should fail its own request, not startup
+            pass
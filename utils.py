@@ -47,6 +47,10 @@ def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     r = 6371  # Radius of earth in kilometers
     return c * r
 
+def geo_point(lat: float, lon: float) -> dict:
+    """GeoJSON Point for a 2dsphere index (note: [longitude, latitude] order)"""
+    return {"type": "Point", "coordinates": [float(lon), float(lat)]}
+
 def format_currency(amount: float) -> str:
     """Format currency amount"""
     return f"{amount:.2f}Ks"
@@ -67,4 +71,4 @@ def equirectangular_distance(lat1: float, lon1: float, lat2: float, lon2: float)
     R = 6371  # Earth radius in kilometers
     x = radians(lon2 - lon1) * cos(radians((lat1 + lat2) / 2))
     y = radians(lat2 - lat1)
-    return sqrt(x*x + y*y) * R
\ No newline at end of file
+    return sqrt(x*x + y*y) * R